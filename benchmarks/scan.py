@@ -0,0 +1,139 @@
+""" Benchmark of mdx.input.scan() against pparser.scanString() on long
+markdown pages, checks that both give the same tags.
+
+    python benchmarks/scan.py [--repeat N] [--fuzz N]
+
+The module needs just the Django settings of the wiki apps, a minimal
+configuration is used unless DJANGO_SETTINGS_MODULE is set. The documents
+have no tabs, markdown expands them before the preprocessor runs. """
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth', 'django.contrib.sites',
+                        'django_nyt', 'mptt', 'sekizai', 'wiki', 'django_wiki_inputs'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        SITE_ID=1,
+    )
+django.setup()
+
+from django_wiki_inputs.mdx.input import pparser, scan  # NOQA
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+TAGS = [
+    '[input a1]',
+    '[input essay type="textarea" can_write="_students_"]',
+    '[input f type="files"]',
+    '[input u type="select-user" values=_students_ default="a@b.c"]',
+    '[display /x/a1]',
+    '[display ../a1]',
+    '[display lib.check(/x/a1, "str", 42, 1.5)]',
+    '[display lib.run(lib.check(/x/a1), lib.prepare(.))]',
+    '[display get(/x/a1, "_all_")]',
+]
+
+BROKEN = [
+    '[input]',
+    '[input a b c]',
+    '[display]',
+    '[display lib.check(/x/a1]',
+    '[ input a1 ]',
+    '[Input A1]',
+    '[display [input a1]]',
+    '[[input a1]]',
+    '[input a1 type=]',
+    '[display lib.check(]',
+]
+
+
+def text(rnd, size):
+    out = list()
+    n = 0
+    while n < size:
+        line = " ".join(rnd.choice(WORDS) for i in range(rnd.randint(4, 16)))
+        if rnd.random() < 0.05:
+            line = "[" + line + "](/link/)"
+        out.append(line)
+        n += len(line) + 1
+
+    return "\n".join(out)
+
+
+def document(rnd, size, tags):
+    """ About size characters of text with the tags spread over it. """
+    parts = [text(rnd, size // (len(tags) + 1))]
+    for t in tags:
+        parts.append(t)
+        parts.append(text(rnd, size // (len(tags) + 1)))
+
+    return "\n".join(parts)
+
+
+def results(it):
+    return [(start, end, t.asDict()) for t, start, end in it]
+
+
+def bench(name, doc, repeat):
+    ts = time.perf_counter()
+    for i in range(repeat):
+        expected = results(pparser.scanString(doc))
+    t_scan_string = (time.perf_counter() - ts) / repeat
+
+    ts = time.perf_counter()
+    for i in range(repeat):
+        got = results(scan(doc))
+    t_scan = (time.perf_counter() - ts) / repeat
+
+    print(f"{name}: {len(doc) // 1000} kB, {len(expected)} tags: "
+          f"scanString {t_scan_string:.3f} s, scan {t_scan:.3f} s, "
+          f"{'identical' if got == expected else 'DIFFERENT'}")
+
+    return got == expected
+
+
+def fuzz(rnd, n):
+    """ Small documents with random tags and fragments of tags. """
+    pieces = TAGS + BROKEN + ["[", "]", "(", ")", "[input ", "[display ", "\n", " ", '"', "/x/", "lib.f("]
+    for i in range(n):
+        doc = "".join(rnd.choice(pieces) if rnd.random() < 0.5 else rnd.choice(WORDS) for i in range(rnd.randint(1, 60)))
+        if results(scan(doc)) != results(pparser.scanString(doc)):
+            print(f"fuzz: different results for {doc!r}")
+            return False
+
+    print(f"fuzz: {n} documents identical")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--fuzz', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+
+    ok = bench("few tags", document(rnd, 200 * 1000, [rnd.choice(TAGS) for i in range(10)]), args.repeat)
+
+    tags = [rnd.choice(TAGS) for i in range(300)] + BROKEN + ['[display lib.run(lib.check(lib.run(/x/a1)))]']
+    rnd.shuffle(tags)
+    ok &= bench("many tags", document(rnd, 370 * 1000, tags), args.repeat)
+
+    ok &= fuzz(rnd, args.fuzz)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
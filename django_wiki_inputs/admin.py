@@ -17,3 +17,17 @@ class InputAdmin(admin.ModelAdmin):
     )
     list_filter = ('article', 'created', 'owner', 'author')
     search_fields = ('name',)
+
+
+@admin.register(models.InputLatest)
+class InputLatestAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'article',
+        'name',
+        'owner',
+        'input',
+    )
+    list_filter = ('article', 'owner')
+    search_fields = ('name',)
+    raw_id_fields = ('input',)
@@ -0,0 +1,158 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from django.core import signing
+from django.urls import reverse
+import hashlib
+import json
+import tempfile
+import logging
+import base64
+import os
+
+from . import settings
+
+import ipdb # NOQA
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore(object):
+    """ Content addressed store of the file input contents, the blobs are
+    keyed by the sha256 hex digest of the content. """
+
+    def put_file(self, f):
+        """ Store the content of the file object, return the digest. """
+        raise NotImplementedError
+
+    def open(self, digest):
+        """ Return a binary file object with the content of the blob. """
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def size(self, digest):
+        raise NotImplementedError
+
+    def put(self, buf):
+        with tempfile.SpooledTemporaryFile() as f:
+            f.write(buf)
+            f.seek(0)
+            return self.put_file(f)
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            return f.read()
+
+
+class FileSystemBlobStore(BlobStore):
+    """ Blobs stored as files <root>/<digest[:2]>/<digest[2:4]>/<digest>. """
+
+    def __init__(self, root=None):
+        self.root = root or settings.BLOB_ROOT
+        if not self.root:
+            raise ImproperlyConfigured("WIKI_INPUTS_BLOB_ROOT is not set")
+
+    def path(self, digest):
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError(f"invalid blob digest {digest!r}")
+
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put_file(self, f):
+        os.makedirs(self.root, exist_ok=True)
+
+        h = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            try:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    h.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+
+        digest = h.hexdigest()
+        path = self.path(digest)
+
+        if os.path.exists(path):
+            # the same content was already stored (other owner or revision)
+            os.unlink(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp.name, 0o644)
+            os.replace(tmp.name, path)
+
+        return digest
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+
+def get_blob_store():
+    if get_blob_store._store is None:
+        get_blob_store._store = import_string(settings.BLOB_STORE)()
+
+    return get_blob_store._store
+
+
+get_blob_store._store = None
+
+
+def file_token(f, user_pk):
+    """ Signed reference to the file of the files input value, the token is
+    issued only to the users who can see the value and it is valid just for
+    the user. The token of the same file and user is always the same, so the
+    browsers can cache the content. """
+    val = json.dumps([f['digest'], f.get('name'), f.get('type'), user_pk], separators=(',', ':'))
+    return signing.Signer(salt='django_wiki_inputs.file').sign(signing.b64_encode(val.encode('utf-8')).decode('ascii'))
+
+
+def file_token_loads(token):
+    val = signing.Signer(salt='django_wiki_inputs.file').unsign(token)
+    digest, name, mime, user_pk = json.loads(signing.b64_decode(val.encode('ascii')).decode('utf-8'))
+    return {'digest': digest, 'name': name, 'type': mime, 'user': user_pk}
+
+
+def file_url(f, user_pk):
+    return reverse('wiki:inputs_file', kwargs={'token': file_token(f, user_pk)})
+
+
+def file_content(f):
+    """ Return the content of the file of the files input value, the value
+    stores the digest of the blob (or the base64 content in old values). """
+    if 'digest' in f:
+        return get_blob_store().get(f['digest'])
+
+    return base64.b64decode(f.get('content', ''))
+
+
+def store_files(val):
+    """ Move the base64 contents of the files input value to the blob store,
+    return the value with the digests. """
+    out = list()
+    for f in val:
+        f = dict(f)
+        if 'content' in f:
+            f['digest'] = get_blob_store().put(base64.b64decode(f.pop('content')))
+        out.append(f)
+
+    return out
+
+
+def inline_files(val):
+    """ Return the files input value with the base64 contents of the blobs. """
+    out = list()
+    for f in val:
+        f = dict(f)
+        if 'digest' in f:
+            f['content'] = base64.b64encode(file_content(f)).decode('ascii')
+        out.append(f)
+
+    return out
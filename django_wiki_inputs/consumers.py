@@ -3,19 +3,34 @@ from channels.generic.websocket import AsyncJsonWebsocketConsumer
 import logging
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from django.db import transaction
+from channels.layers import get_channel_layer
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.utils import timezone
+import collections
 import asyncio
+import time
 import re
 import pathlib
 import json
 from aiostream import stream
 import magic
 import base64
+import tempfile
+import uuid
+import weakref
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from . import stream as my_stream
 from . import models
 from . import misc
+from . import blobs
+from . import settings
 from .fn import * # NOQA
 
 import ipdb # NOQA
@@ -24,41 +39,370 @@ logger = logging.getLogger(__name__)
 
 preview_re = re.compile(r'^(.+/|)_preview/$')
 
-@database_sync_to_async
-def db_update_input(article, name, user, owner, val):
-    val_json = json.dumps(val)
+def dbsync_update_inputs(items):
+    """ Store the new values, items are (article, name, user, owner, val).
+    Return list of (article, name, owner, out), out is the stored value
+    serialized (see stream.input_to_dict) with pk of the previous value in
+    'prev'. Unchanged values are skipped. """
+    for retry in range(3):
+        try:
+            return _dbsync_update_inputs(items)
+        except IntegrityError as e:
+            # the first value of a field was stored concurrently, there is a
+            # row to lock now
+            if retry == 2:
+                raise
+            logger.info(f"concurrent input update, retrying: {e}")
+
+
+def _dbsync_update_inputs(items):
     ts = timezone.now()
+    out = list()
 
     with transaction.atomic():
-        old_qs = models.Input.objects.filter(
-            article=article,
-            name=name,
-            owner=owner)
+        q = Q(pk__isnull=True)
+        for article, name, user, owner, val in items:
+            q |= Q(article=article, name=name, owner=owner)
 
-        if old_qs.exists():
-            old = old_qs.latest()
+        latest = dict()
+        for cur in models.InputLatest.objects.select_for_update().select_related('input').filter(q):
+            latest[(cur.article_id, cur.name, cur.owner_id)] = cur
 
-            if old.val == val_json:
-                return
+        new = list()
+        for article, name, user, owner, val in items:
+            val_json = json.dumps(val)
+            cur = latest.get((article.pk, name, owner.pk))
+
+            if cur is not None:
+                if cur.input.val == val_json:
+                    continue
+
+                if ts <= cur.input.created:
+                    logger.error(f"{user}@{article}/{name}: time error! ({ts} <= {cur.input.created}")
+                    continue
+
+            new.append((cur, models.Input(
+                article=article,
+                name=name,
+                created=ts,
+                owner=owner,
+                author=user,
+                val=val_json)))
+
+        models.Input.objects.bulk_create([n for cur, n in new])
+
+        latest_new = list()
+        for cur, n in new:
+            if n.pk is None:
+                # the backend does not return pks from the bulk insert
+                n = models.Input.objects.get(article=n.article, name=n.name, owner=n.owner, created=n.created)
+
+            if cur is None:
+                latest_new.append(models.InputLatest(article=n.article, name=n.name, owner=n.owner, input=n))
+            else:
+                models.InputLatest.objects.filter(pk=cur.pk).update(input=n)
+
+            o = my_stream.input_to_dict(n)
+            o['prev'] = None if cur is None else cur.input.pk
+            out.append((n.article, n.name, n.owner, o))
+
+        models.InputLatest.objects.bulk_create(latest_new)
+
+    return out
+
+
+db_update_inputs = database_sync_to_async(dbsync_update_inputs)
+
+
+@database_sync_to_async
+def db_update_input(article, name, user, owner, val):
+    """ Store the new value, see dbsync_update_inputs. """
+    out = dbsync_update_inputs([(article, name, user, owner, val)])
+    return out[0][3] if out else None
+
+
+def group_name(article_pk, name, owner_pk):
+    return f"wiki-inputs.{article_pk}.{name}.{owner_pk}"
+
+
+async def publish_change(article, name, owner, val):
+    """ Wake readers of the owner's article field in all the processes, val is
+    the new value as returned by db_update_input (or a pending one). """
+    owners = [(owner.pk, val)]
+    if val is not None and 'prev' in val and val['prev'] is None:
+        owners.append((misc.NEW_OWNER, None))
+
+    layer = get_channel_layer()
+    for owner_pk, v in owners:
+        if layer is None:
+            await misc.get_markdown_factory().notify(article.pk, name, owner_pk, v)
+            continue
+
+        await layer.group_send(group_name(article.pk, name, owner_pk), {
+            'type': 'input.changed',
+            'event': uuid.uuid4().hex,
+            'article': article.pk,
+            'name': name,
+            'owner': owner_pk,
+            'val': v,
+        })
+
+
+class _InputWriter(object):
+    """ Write-behind buffer of the input values. Readers are notified about a
+    new value immediately, the latest value of the (article, name, owner) is
+    stored after settings.WRITE_DELAY seconds without a change. """
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.task = None
+
+    async def write(self, article, name, user, owner, val):
+        if settings.WRITE_DELAY <= 0 or val['type'] in ['file', 'files']:
+            n = await db_update_input(article, name, user, owner, val)
+            if n is not None:
+                await publish_change(article, name, owner, n)
+            return
 
-            if ts <= old.created:
-                logger.error(f"{user}@{article}/{name}: time error! ({ts} <= {old.created}")
+        key = (article.pk, name, owner.pk)
+        self.pending.pop(key, None)
+        self.pending[key] = (article, name, user, owner, val, 0, time.monotonic())
+
+        out = dict(val)
+        out.update(pk=None, created=timezone.now().isoformat(), author=user.username, pending=True)
+        await publish_change(article, name, owner, out)
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            while self.pending:
+                now = time.monotonic()
+                due = [k for k, v in self.pending.items() if now - v[-1] >= settings.WRITE_DELAY]
+
+                if due:
+                    await self.flush(due)
+                else:
+                    ts = min(v[-1] for v in self.pending.values())
+                    await asyncio.sleep(ts + settings.WRITE_DELAY - now)
+        finally:
+            self.task = None
+
+    async def flush(self, keys=None):
+        """ Store the pending values (all of them if keys is None). """
+        if keys is None:
+            keys = list(self.pending.keys())
+
+        items = [self.pending.pop(k) for k in keys if k in self.pending]
+        if not items:
+            return
+
+        try:
+            out = await db_update_inputs([i[:5] for i in items])
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+            if len(items) == 1:
+                self.retry(items[0], e)
                 return
 
-        n = models.Input.objects.create(
-            article=article,
-            name=name,
-            created=ts,
-            owner=owner,
-            author=user,
-            val=val_json)
+            # store the values one by one, the failed ones are retried
+            out = list()
+            for i in items:
+                try:
+                    out += await db_update_inputs([i[:5]])
+                except Exception as e:
+                    self.retry(i, e)
+
+        for article, name, owner, n in out:
+            await publish_change(article, name, owner, n)
+
+    def retry(self, item, e):
+        article, name, user, owner, val, tries, ts = item
+        key = (article.pk, name, owner.pk)
+
+        if key in self.pending:
+            return      # there is a newer value already
+
+        if tries + 1 >= settings.WRITE_RETRIES:
+            logger.error(f"{user}@{article}/{name}: value lost after {tries + 1} tries: {e}")
+
+            # the readers show the pending value, make them read the stored one
+            asyncio.ensure_future(publish_change(article, name, owner, None))
+            return
+
+        logger.warning(f"{user}@{article}/{name}: store failed, retrying: {e}")
+        self.pending[key] = (article, name, user, owner, val, tries + 1, time.monotonic())
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
 
-    return n
+def get_input_writer():
+    if get_input_writer._w is None:
+        get_input_writer._w = _InputWriter()
+
+    return get_input_writer._w
+
+
+get_input_writer._w = None
+
+
+def display_patch(last, cells):
+    """ Return the list of the changes of the display table from the last
+    cells to the cells, None if the table must be replaced:
+
+    ['cell', row key, column, html] - replace the cell of the row
+    ['row', row key, index, html] - insert the row at the index
+    ['del', row key] - remove the row
+    """
+    if last is None or last['info'] != cells['info']:
+        return None
+
+    old = collections.OrderedDict((r[0], r) for r in last['rows'])
+    new = collections.OrderedDict((r[0], r) for r in cells['rows'])
+
+    # the rows kept in the table have to be in the same order
+    if [k for k in old if k in new] != [k for k in new if k in old]:
+        return None
+
+    patch = [['del', k] for k in old if k not in new]
+
+    for i, (k, r) in enumerate(new.items()):
+        if k not in old:
+            patch.append(['row', k, i, r[1]])
+            continue
+
+        if len(old[k][2]) != len(r[2]):
+            return None
+
+        for j, (a, b) in enumerate(zip(old[k][2], r[2])):
+            if a != b:
+                patch.append(['cell', k, j, b])
+
+    return patch
+
+
+class _Outbox(object):
+    """ Messages waiting to be sent to the client, just the latest message of
+    every (type, id) is kept. """
+
+    # process-wide counters: queued, coalesced and sent messages
+    stats = collections.Counter()
+    boxes = weakref.WeakSet()
+
+    def __init__(self):
+        self.msgs = collections.OrderedDict()
+        self.ready = asyncio.Event()
+        self.closed = False
+
+        _Outbox.boxes.add(self)
+
+    def put(self, msg):
+        key = (msg['type'], msg.get('id'))
+        if key in self.msgs:
+            _Outbox.stats['coalesced'] += 1
+
+        _Outbox.stats['queued'] += 1
+        self.msgs[key] = msg
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self):
+        """ Return all the pending messages, an empty list if the outbox is
+        closed. """
+        while not self.msgs and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+
+        msgs = list(self.msgs.values())
+        self.msgs.clear()
+        return msgs
+
+
+def outbox_stats():
+    """ Counters of the outgoing messages and the current queue depths. """
+    depth = [len(b.msgs) for b in list(_Outbox.boxes)]
+
+    out = dict(_Outbox.stats)
+    out['consumers'] = len(depth)
+    out['pending'] = sum(depth)
+    out['max_pending'] = max(depth) if depth else 0
+    return out
+
+
+class _Upload(object):
+    """ Files of the files input uploaded in chunks. """
+
+    def __init__(self, content, files):
+        # the field of the upload, the permissions are checked again when
+        # the upload is finished
+        self.request = {k: content[k] for k in ['id', 'owner'] if k in content}
+        self.files = list()
+
+        for f in files:
+            if type(f['size']) is not int or f['size'] < 0:
+                raise ValueError(f"invalid size {f['size']!r}")
+
+        if sum(f['size'] for f in files) > settings.UPLOAD_MAX_SIZE:
+            raise ValueError(f"upload is larger than {settings.UPLOAD_MAX_SIZE} bytes")
+
+        for f in files:
+            self.files.append({
+                'name': str(f['name']),
+                'size': f['size'],
+                'type': str(f.get('type', '')),
+                'offset': 0,
+                'buf': tempfile.SpooledTemporaryFile(max_size=1024*1024),
+            })
+
+    def done(self):
+        return all(f['offset'] == f['size'] for f in self.files)
+
+    def get_val(self):
+        val = list()
+        for f in self.files:
+            f['buf'].seek(0)
+            val.append({
+                'name': f['name'],
+                'size': f['size'],
+                'type': f['type'] or 'application/x-empty',
+                'digest': blobs.get_blob_store().put_file(f['buf']),
+            })
+            f['buf'].close()
+
+        return val
+
+    def close(self):
+        for f in self.files:
+            f['buf'].close()
+
+
+def get_uploads():
+    """ Unfinished uploads by (user pk, upload uid), an upload can be resumed
+    on a new connection (of the same process). """
+    if get_uploads._u is None:
+        get_uploads._u = misc.LRUCache(1024, 3600)
+
+    return get_uploads._u
+
+
+get_uploads._u = None
 
 
 class InputConsumer(AsyncJsonWebsocketConsumer):
+    # the wire format negotiated by the client in the query string, e.g.
+    # ?enc=msgpack&compress=zlib, the default is JSON in the text frames
+    encoding = 'json'
+    compress = False
+
     async def connect(self, *args, **kwargs):  # NOQA
         self.user = self.scope['user']
+        self.groups_joined = set()
         if not self.user.is_authenticated:
             await self.close()
             return
@@ -74,8 +418,17 @@ class InputConsumer(AsyncJsonWebsocketConsumer):
             return
 
         self.path = pathlib.Path(qs['path'][0])
+
+        if qs.get('enc', ['json'])[0] == 'msgpack':
+            if msgpack is not None:
+                self.encoding = 'msgpack'
+            else:
+                logger.warning(f"{self.user}@{self.path}: msgpack is not installed, using json")
+
+        self.compress = qs.get('compress', [''])[0] == 'zlib'
         self.preview = preview_re.match(str(self.path))
         self.dummy_val = dict()
+        self.displays = dict()
 
         if self.preview:
             await self.accept()
@@ -103,42 +456,147 @@ class InputConsumer(AsyncJsonWebsocketConsumer):
         await self.accept()
 
 
-    async def run(self):
+    async def read(self):
         try:
             async with self.stream.stream() as s:
                 async for msg in s:
+                    self.outbox.put(msg)
+        finally:
+            self.outbox.close()
+
+
+    async def run(self):
+        self.outbox = _Outbox()
+        reader = asyncio.ensure_future(self.read())
+
+        try:
+            while True:
+                msgs = await self.outbox.get()
+                if not msgs:
+                    break
+
+                ts = time.monotonic()
+                for msg in msgs:
+                    if msg['type'] == 'display':
+                        msg = self.display_msg(msg)
+                        if msg is None:
+                            continue
+
                     logger.debug(f"{self.user}@{self.path}: send {{:.80s}} ...".format(' '.join(str(msg).split())))
                     await self.send_json(msg)
+                    _Outbox.stats['sent'] += 1
+
+                # the messages produced meanwhile are coalesced
+                await asyncio.sleep(ts + settings.SEND_INTERVAL - time.monotonic())
+
+            await reader
         except asyncio.CancelledError:
             pass
         except Exception as e:
             logger.error(e, exc_info=True)
         finally:
+            reader.cancel()
             self.close()
 
 
+    async def send_json(self, content, close=False):
+        """ Send the message in the negotiated format, the binary frames start
+        with a byte of flags: 1 - msgpack (JSON otherwise), 2 - zlib. """
+        if self.encoding == 'json' and not self.compress:
+            await super().send_json(content, close=close)
+            return
+
+        flags = 0
+        if self.encoding == 'msgpack':
+            buf = msgpack.packb(content, use_bin_type=True)
+            flags |= 1
+        else:
+            buf = json.dumps(content).encode('utf-8')
+
+        if self.compress and len(buf) >= settings.COMPRESS_MIN_SIZE:
+            buf = zlib.compress(buf)
+            flags |= 2
+
+        await self.send(bytes_data=bytes([flags]) + buf, close=close)
+
+
+    def display_msg(self, msg):
+        """ Replace the display message with the patch of the last sent
+        display if possible, None if nothing changed. """
+        val = msg['val']
+        cells = None
+
+        if val is not None and 'cells' in val:
+            cells = val['cells']
+            val = {k: v for k, v in val.items() if k != 'cells'}
+            msg = dict(msg, val=val)
+
+        last = self.displays.get(msg['id'])
+        self.displays[msg['id']] = (cells, msg)
+
+        if cells is None or last is None:
+            return msg
+
+        patch = display_patch(last[0], cells)
+        if patch is None:
+            return msg
+
+        if not patch:
+            return None
+
+        return {'type': 'display', 'id': msg['id'], 'patch': patch}
+
+
     async def disconnect(self, close_code):
         if hasattr(self, 'run_task'):
             self.run_task.cancel()
 
+        writer = get_input_writer()
+        await writer.flush([k for k, v in writer.pending.items() if v[2] == self.user])
 
-    async def receive_json(self, content):  # NOQA
+        for group in getattr(self, 'groups_joined', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+
+    async def subscribe(self, article, name, owner_pk):
+        if self.channel_layer is None:
+            return
+
+        group = group_name(article.pk, name, owner_pk)
+        if group not in self.groups_joined:
+            self.groups_joined.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+
+
+    async def input_changed(self, event):
+        await misc.get_markdown_factory().notify(event['article'], event['name'], event['owner'], event['val'], event['event'])
+
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None:
+            await self.receive_chunk(bytes_data)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+
+    async def get_field_owner(self, content):
+        """ Return the field of the request and the owner of the value, the
+        field is None if the user can not write it. """
         try:
             field = self.md.input_fields[content['id']]
-            val = content['val']
             owner = content.get('owner', self.user)
         except Exception:
             logger.warning(f"{self.user}@{self.path}: broken request - {content}")
-            return
+            return None, None
 
         if not field['can_read']:
-            return
+            return None, None
 
         if field['can_write'] is False:
-            return
+            return None, None
 
         if field['can_write'] is None and owner != self.user:
-            return
+            return None, None
 
         owner = None
         if 'owner' in field['args']:
@@ -153,6 +611,31 @@ class InputConsumer(AsyncJsonWebsocketConsumer):
                     assert isinstance(v.get('val'), User)
                     owner = v.get('val')
 
+        return field, owner
+
+
+    async def receive_json(self, content):  # NOQA
+        if 'upload' in content:
+            await self.receive_upload(content)
+            return
+
+        if 'resync' in content:
+            # the client failed to apply a display patch
+            last = self.displays.get(content['resync'])
+            if last is not None:
+                await self.send_json(last[1])
+            return
+
+        try:
+            val = content['val']
+        except Exception:
+            logger.warning(f"{self.user}@{self.path}: broken request - {content}")
+            return
+
+        field, owner = await self.get_field_owner(content)
+        if field is None:
+            return
+
         if owner:
             logger.debug(f"get {field['name']}: {owner}@{field['args']['type']} {val}")
         else:
@@ -163,14 +646,10 @@ class InputConsumer(AsyncJsonWebsocketConsumer):
             if field['args']['type'] in ['file', 'files']:
                 for i, x in enumerate(val):
                     buf = base64.b64decode(x['content'], validate=True)
-                    m = magic.detect_from_content(buf)
+                    val[i]['type'] = self.check_mime_type(val[i]['type'], buf)
 
-                    if val[i]['type'] != m.mime_type:
-                        if m.mime_type.startswith('text/') and val[i]['type'].startswith('text/'):
-                            pass    # libmagic is not good in text format detection
-                        else:
-                            logger.warning(f"{self.user}@{self.path}: different mimetype ({val[i]['type']} != {m.mime_type})")
-                            val[i]['type'] = m.mime_type
+                loop = asyncio.get_event_loop()
+                val = await loop.run_in_executor(None, blobs.store_files, val)
 
             elif field['args']['type'] in ['select-user']:
                 val = field['args']['values'][int(val)]
@@ -179,13 +658,115 @@ class InputConsumer(AsyncJsonWebsocketConsumer):
             logger.warning(f"{self.user}@{self.path}: broken request - {e}")
             return
 
+        await self.update_field(field, owner, val)
+
 
+    def check_mime_type(self, mime_type, buf):
+        """ Return the mime type of the file content. """
+        if not buf:
+            return 'application/x-empty'
+
+        m = magic.detect_from_content(buf)
+
+        if mime_type != m.mime_type:
+            if m.mime_type.startswith('text/') and mime_type.startswith('text/'):
+                pass    # libmagic is not good in text format detection
+            else:
+                logger.warning(f"{self.user}@{self.path}: different mimetype ({mime_type} != {m.mime_type})")
+                return m.mime_type
+
+        return mime_type
+
+
+    async def update_field(self, field, owner, val):
         if field['args'].get('dummy', False):
             self.dummy_val[field['name']] = {'type': field['args']['type'], 'val': val}
+            await misc.get_markdown_factory().notify(self.md.article.pk, field['name'], None)
         else:
-            await db_update_input(self.md.article, field['name'], self.user,
-                                  self.user if owner is None else owner,
-                                  {'type': field['args']['type'], 'val': val})
+            owner = self.user if owner is None else owner
+            await get_input_writer().write(self.md.article, field['name'], self.user, owner,
+                                           {'type': field['args']['type'], 'val': val})
+
+
+    async def receive_upload(self, content):
+        """ Start (or resume) a chunked upload of the files input, the content
+        is {'upload': 'start', 'uid': ..., 'id': ..., 'files': [{'name': ...,
+        'size': ..., 'type': ...}, ...]}. """
+        if getattr(self, 'md', None) is None:
+            return
+
+        uid = content.get('uid')
+        try:
+            upload = get_uploads().get(self.upload_key(uid))
+        except KeyError:
+            field, owner = await self.get_field_owner(content)
+            if field is None or field['args']['type'] not in ['file', 'files']:
+                return
+
+            try:
+                upload = _Upload(content, content['files'])
+            except Exception as e:
+                logger.warning(f"{self.user}@{self.path}: broken upload - {e}")
+                await self.send_json({'type': 'upload', 'uid': uid, 'error': str(e)})
+                return
+
+            get_uploads().put(self.upload_key(uid), upload)
+
+        await self.send_json({'type': 'upload', 'uid': uid, 'offsets': [f['offset'] for f in upload.files]})
+        await self.finish_upload(uid, upload)
+
+
+    def upload_key(self, uid):
+        """ The uploads are bound to the user and the article, an upload can
+        be resumed just on the same page. """
+        return (self.user.pk, self.md.article.pk, uid)
+
+
+    async def receive_chunk(self, data):
+        """ Binary frame with a chunk of an upload: 4 bytes (big endian) length
+        of the JSON header {'uid': ..., 'file': ..., 'offset': ...}, the
+        header and the chunk. """
+        try:
+            n = int.from_bytes(data[:4], 'big')
+            hdr = json.loads(data[4:4+n].decode('utf-8'))
+            uid = hdr['uid']
+            upload = get_uploads().get(self.upload_key(uid))
+            if type(hdr['file']) is not int or not 0 <= hdr['file'] < len(upload.files):
+                raise ValueError(f"invalid file {hdr['file']!r}")
+            f = upload.files[hdr['file']]
+        except Exception as e:
+            logger.warning(f"{self.user}@{self.path}: broken chunk - {e}")
+            return
+
+        chunk = data[4+n:]
+        if hdr['offset'] == f['offset'] and f['offset'] + len(chunk) <= f['size']:
+            if f['offset'] == 0:
+                f['type'] = self.check_mime_type(f['type'], chunk)
+
+            f['buf'].write(chunk)
+            f['offset'] += len(chunk)
+
+        # the client continues from the acknowledged offset
+        await self.send_json({'type': 'upload', 'uid': uid, 'file': hdr['file'], 'offset': f['offset']})
+        await self.finish_upload(uid, upload)
+
+
+    async def finish_upload(self, uid, upload):
+        if not upload.done():
+            return
+
+        get_uploads().pop(self.upload_key(uid))
+
+        # the permissions could change since the upload was started
+        field, owner = await self.get_field_owner(upload.request)
+        if field is None or field['args']['type'] not in ['file', 'files']:
+            upload.close()
+            await self.send_json({'type': 'upload', 'uid': uid, 'error': "permission denied"})
+            return
+
+        loop = asyncio.get_event_loop()
+        val = await loop.run_in_executor(None, upload.get_val)
 
-        async with field['cv']:
-            field['cv'].notify_all()
+        logger.debug(f"get {field['name']}: {field['args']['type']} upload {uid}")
+        await self.update_field(field, owner, val)
+        await self.send_json({'type': 'upload', 'uid': uid, 'done': True})
@@ -1,10 +1,16 @@
 import io
 import os
+import atexit
 import tarfile
+import collections
+import itertools
+import hashlib
 import aiodocker
 import asyncio
 from aiostream import core, stream
 from .. import misc
+from .. import blobs
+from .. import settings
 from .. import stream as my_stream
 import logging
 import json
@@ -27,24 +33,61 @@ class MyException(Exception):
     pass
 
 
-async def send_item(ws, con, aout, item):
+def item_json(item):
     try:
-        out = json.dumps(item)
+        return json.dumps(item)
     except TypeError:
         if isinstance(item[1]['val'], models.Model):
             item = (item[0], item[1].copy())
             item[1]['model'] = str(item[1]['val']._meta)
             item[1]['val'] = item[1]['val'].pk
 
-        out = json.dumps(item)
+        return json.dumps(item)
+
+
+async def send_item(ws, con, aout, item):
+    """ Send the item to the container, return False if it was already sent. """
+    out = item_json(item)
 
     if aout.get(item[0], None) == out:
-        return
+        return False
 
     logger.debug(f"{con['id'][:12]}: < {out[:120]}")
     aout[item[0]] = out
 
+    if isinstance(item[1], dict) and item[1].get('type') in ['file', 'files']:
+        # the containers get the file contents, not the blob digests
+        loop = asyncio.get_event_loop()
+        val = await loop.run_in_executor(None, blobs.inline_files, item[1]['val'])
+        out = item_json((item[0], dict(item[1], val=val)))
+
     await ws.send_str(out + "\n")
+    return True
+
+
+def result_key(img, aout):
+    """ Key of the container results for the items sent (see send_item). """
+    h = hashlib.sha256()
+    for k in sorted(aout, key=str):
+        h.update(aout[k].encode('utf-8'))
+        h.update(b"\n")
+
+    return (img, h.hexdigest())
+
+
+def get_result_cache():
+    """ Results of the container runs marked by '# WI-NATIVE cache', it maps
+    result_key to the list of the messages produced. """
+    if get_result_cache._c is None:
+        get_result_cache._c = misc.LRUCache(
+            settings.DOCKER_RESULT_CACHE_BYTES,
+            settings.DOCKER_RESULT_CACHE_AGE,
+            sizeof=lambda msgs: len(json.dumps(msgs)))
+
+    return get_result_cache._c
+
+
+get_result_cache._c = None
 
 
 async def get_dockerfile(dapi, from_image, md, path, user):
@@ -98,28 +141,32 @@ async def get_dockerfile(dapi, from_image, md, path, user):
     return obj
 
 
-async def get_image(dapi, path, user):  # NOQA
-    md = await misc.get_markdown_factory().get_markdown(str(path), user)
-    if md is None:
-        raise MyException(f"{path} does not exists")
+def get_context_digest(from_image, md, path):
+    """ Digest of everything get_dockerfile puts into the build context, the
+    article revisions not touching the sources share the image. """
+    h = hashlib.sha256()
+    h.update(json.dumps([from_image, str(path)]).encode('utf-8'))
 
-    if str(path) == '/':
-        from_image = "jenda1/testovadlo"
-        rebuild_required = False
-        image_tag = f"wikilt:{md.article.current_revision.pk}"
-    else:
-        from_image, rebuild_required = await get_image(dapi, path.parent, user)
-        ptag = from_image.split(':')[-1]
-        image_tag = f"wikilt{path!s}:{ptag}.{md.article.current_revision.pk}"
+    for fn, item in md.source_fields.items():
+        h.update(json.dumps([fn, item.get('type'), item['text']]).encode('utf-8'))
 
-    if not rebuild_required:
-        try:
-            await dapi.images.inspect(image_tag)
-            logger.debug(f"{path}@{user}: re-use container {image_tag}")
-            return image_tag, False
-        except aiodocker.exceptions.DockerError as e:
-            if e.status != 404:
-                raise e
+    return h.hexdigest()[:24]
+
+
+async def image_exists(dapi, image_tag):
+    try:
+        await dapi.images.inspect(image_tag)
+        return True
+    except aiodocker.exceptions.DockerError as e:
+        if e.status != 404:
+            raise e
+        return False
+
+
+async def build_image(dapi, from_image, rebuild_required, image_tag, md, path, user):
+    if not rebuild_required and await image_exists(dapi, image_tag):
+        logger.debug(f"{path}@{user}: re-use container {image_tag}")
+        return image_tag, False
 
     log = list()
 
@@ -143,22 +190,357 @@ async def get_image(dapi, path, user):  # NOQA
     return image_tag, True
 
 
-async def get_container(dapi, path, user):
-    if not hasattr(get_container, "_lock"):
-        get_container._lock = asyncio.Lock()
+async def get_image(dapi, path, user):  # NOQA
+    md = await misc.get_markdown_factory().get_markdown(str(path), user)
+    if md is None:
+        raise MyException(f"{path} does not exists")
+
+    if str(path) == '/':
+        from_image = "jenda1/testovadlo"
+        rebuild_required = False
+        image_tag = f"wikilt:{get_context_digest(from_image, md, path)}"
+    else:
+        from_image, rebuild_required = await get_image(dapi, path.parent, user)
+        image_tag = f"wikilt{path!s}:{get_context_digest(from_image, md, path)}"
+
+    # the tag identifies the build context (and so the whole chain of the
+    # parent images), known tags are used without asking docker
+    if not rebuild_required:
+        try:
+            get_image._images.get(image_tag)
+            return image_tag, False
+        except KeyError:
+            pass
+
+    # concurrent executions share one inspect/build of the tag
+    fut = get_image._builds.get(image_tag)
+    if fut is None:
+        fut = asyncio.ensure_future(build_image(dapi, from_image, rebuild_required, image_tag, md, path, user))
+        fut.add_done_callback(lambda f: get_image._builds.pop(image_tag, None))
+        get_image._builds[image_tag] = fut
+
+    out = await asyncio.shield(fut)
+    get_image._images.put(image_tag, True)
+    return out
+
+
+# tags are re-checked after an hour, the image may be removed meanwhile
+get_image._images = misc.LRUCache(1024, 3600)
+get_image._builds = dict()
+
+
+def container_config(img):
+    return {"Image": img,
+            "AttachStdin": True,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Tty": False,
+            "OpenStdin": True,
+            "StdinOnce": True,
+            "Labels": {'django.wiki.inputs': '1'},
+            }
+
+
+def get_docker():
+    """ Process wide docker client of the API calls, they share its (bounded)
+    connection pool. The containers are attached through attach_container. """
+    if get_docker._d is None:
+        # aiodocker resolves the host (DOCKER_HOST, TLS, contexts, the socket
+        # search)
+        get_docker._d = aiodocker.Docker()
+
+        if not get_docker._atexit:
+            atexit.register(shutdown_docker)
+            get_docker._atexit = True
+
+    return get_docker._d
+
+
+get_docker._d = None
+get_docker._atexit = False
+
+
+def docker_stats():
+    """ Saturation of the docker client connection pool. """
+    if get_docker._d is None:
+        return {'limit': None, 'acquired': 0, 'waiting': 0, 'attached': attach_container._n}
+
+    connector = get_docker._d.session.connector
+    return {
+        'limit': connector.limit,
+        'acquired': len(getattr(connector, '_acquired', ())),
+        'waiting': sum(len(w) for w in getattr(connector, '_waiters', dict()).values()),
+        'attached': attach_container._n,
+    }
+
+
+async def attach_container(dapi, con):
+    """ Attach the websocket of the container, return (client, websocket).
+    The websocket holds its connection while the display is shown, so it
+    has a client of its own: in the shared pool the attached containers
+    would take all the connections and block the API calls (the delete of
+    the container when its viewer leaves). """
+    client = aiodocker.Docker(api_version=dapi.api_version)
+    try:
+        ws = await client.containers.container(con['id']).websocket(stdin=True, stdout=True, stderr=True, stream=True)
+    except BaseException:
+        await client.close()
+        raise
+
+    attach_container._n += 1
+    return client, ws
+
+
+attach_container._n = 0
+
+
+async def detach_container(client, ws):
+    """ Close the websocket opened by attach_container. """
+    try:
+        await ws.close()
+    finally:
+        attach_container._n -= 1
+        await client.close()
+
+
+async def close_docker():
+    """ Shutdown hook, delete the pooled containers and close the client. """
+    if get_container_pool._p is not None:
+        await get_container_pool._p.close()
+
+    if get_docker._d is not None:
+        dapi, get_docker._d = get_docker._d, None
+        await dapi.close()
+
+
+def shutdown_docker():
+    """ atexit hook running close_docker(). The event loop of the server is
+    usually stopped by now, then the pooled containers are deleted with a
+    new client in a new loop. """
+    try:
+        loop = asyncio.get_event_loop()
+        if loop.is_closed() or loop.is_running():
+            raise RuntimeError("the event loop is not usable")
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        get_docker._d = None
+
+    try:
+        loop.run_until_complete(close_docker())
+    except Exception as e:
+        logger.warning(f"docker shutdown failed: {e!s}")
+
+
+class _ContainerPool(object):
+    """ Pool of created, not yet started containers per image tag. The
+    containers are one-shot (StdinOnce), so a used container is deleted and
+    the pool is refilled in the background. """
+
+    def __init__(self, dapi=None):
+        self.dapi = dapi
+
+        self.idle = collections.defaultdict(collections.deque)
+        self.target = dict()
+        self.filling = dict()
+        self.reaper = None
+
+    def get_dapi(self):
+        return get_docker() if self.dapi is None else self.dapi
+
+    async def create(self, tag):
+        return await self.get_dapi().containers.create(config=container_config(tag))
+
+    async def healthy(self, con):
+        try:
+            info = await con.show()
+            return info['State']['Status'] == 'created'
+        except aiodocker.exceptions.DockerError:
+            return False
+
+    async def discard(self, con):
+        try:
+            await con.delete(force=True)
+        except aiodocker.exceptions.DockerError as e:
+            if e.status != 404:
+                logger.warning(f"{con['id'][:12]}: delete failed: {e!s}")
+
+    async def checkout(self, tag):
+        idle = self.idle[tag]
+        self.target.setdefault(tag, settings.DOCKER_POOL_MIN)
+
+        while idle:
+            con, ts = idle.popleft()
+            if await self.healthy(con):
+                self.refill(tag)
+                return con
+
+            await self.discard(con)
+
+        # the pool was too small, grow it
+        self.target[tag] = min(self.target[tag] + 1, settings.DOCKER_POOL_MAX)
+        self.refill(tag)
+
+        return await self.create(tag)
+
+    async def release(self, con):
+        await self.discard(con)
+
+    def refill(self, tag):
+        if tag not in self.filling:
+            self.filling[tag] = asyncio.ensure_future(self.fill(tag))
+
+        if self.reaper is None:
+            self.reaper = asyncio.ensure_future(self.reap())
+
+    async def fill(self, tag):
+        try:
+            while len(self.idle[tag]) < self.target.get(tag, 0):
+                con = await self.create(tag)
+                self.idle[tag].append((con, time.monotonic()))
+        except Exception as e:
+            logger.warning(f"{tag}: pool fill failed: {e!s}")
+        finally:
+            del self.filling[tag]
+
+    async def reap(self):
+        """ Delete containers idle for more than DOCKER_POOL_TTL seconds. """
+        try:
+            while self.idle:
+                await asyncio.sleep(settings.DOCKER_POOL_TTL / 2)
+                now = time.monotonic()
+
+                for tag, idle in list(self.idle.items()):
+                    while idle and now - idle[0][1] > settings.DOCKER_POOL_TTL:
+                        con, ts = idle.popleft()
+                        await self.discard(con)
+
+                    if not idle and tag not in self.filling:
+                        del self.idle[tag]
+                        self.target.pop(tag, None)
+        finally:
+            self.reaper = None
+
+    async def close(self):
+        # through the current client, close_docker() may run with a new one
+        dapi = self.get_dapi()
+        for idle in self.idle.values():
+            while idle:
+                con, ts = idle.popleft()
+                await self.discard(dapi.containers.container(con['id']))
+
+
+def get_container_pool():
+    if get_container_pool._p is None:
+        get_container_pool._p = _ContainerPool()
+
+    return get_container_pool._p
+
+
+get_container_pool._p = None
+
+
+class _Ticket(object):
+    def __init__(self, user, article, priority, seq):
+        self.user = user
+        self.article = article
+        self.priority = priority
+        self.seq = seq
+
+        self.granted = False
+        self.released = False
+        self.position = None
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        """ Wait for a change of the queue. """
+        await self.event.wait()
+        self.event.clear()
+
+
+class _Scheduler(object):
+    """ Limits the number of computing containers (a container with new
+    inputs, or a started one without inputs, until it answers), globally and per user and
+    article (0 is no limit). The waiting executions are served by priority,
+    then by the number of containers already running for their user, then
+    in the order of arrival. """
+
+    def __init__(self):
+        self.queue = list()
+        self.seq = itertools.count()
+        self.running = 0
+        self.per_user = collections.Counter()
+        self.per_article = collections.Counter()
+
+    def order(self, t):
+        return (t.priority, self.per_user[t.user], t.seq)
+
+    def allowed(self, t):
+        return all(limit <= 0 or n < limit for n, limit in [
+            (self.running, settings.DOCKER_MAX_RUNNING),
+            (self.per_user[t.user], settings.DOCKER_MAX_RUNNING_USER),
+            (self.per_article[t.article], settings.DOCKER_MAX_RUNNING_ARTICLE),
+        ])
+
+    def enqueue(self, user, article, priority):
+        t = _Ticket(user, article, priority, next(self.seq))
+        self.queue.append(t)
+        self.dispatch()
+        return t
+
+    def dispatch(self):
+        waiting = list()
+        for t in sorted(self.queue, key=self.order):
+            if self.allowed(t):
+                t.granted = True
+                t.event.set()
+
+                self.running += 1
+                self.per_user[t.user] += 1
+                self.per_article[t.article] += 1
+            else:
+                waiting.append(t)
+
+        # the positions changed
+        self.queue = waiting
+        for i, t in enumerate(waiting):
+            t.position = i + 1
+            t.event.set()
+
+    def release(self, t):
+        if t.released:
+            return
+        t.released = True
+
+        if t.granted:
+            self.running -= 1
+            self.per_user[t.user] -= 1
+            self.per_article[t.article] -= 1
+            self.per_user += collections.Counter()      # drop the zeros
+            self.per_article += collections.Counter()
+        else:
+            self.queue.remove(t)
 
-    async with get_container._lock:
-        img, rebuilded = await get_image(dapi, path, user)
-        config = {"Image": img,
-                  "AttachStdin": True,
-                  "AttachStdout": True,
-                  "AttachStderr": True,
-                  "Tty": False,
-                  "OpenStdin": True,
-                  "StdinOnce": True,
-                  }
+        self.dispatch()
 
-        return await dapi.containers.create(config=config)
+    def stats(self):
+        return {'running': self.running, 'waiting': len(self.queue)}
+
+
+def get_scheduler():
+    if get_scheduler._s is None:
+        get_scheduler._s = _Scheduler()
+
+    return get_scheduler._s
+
+
+get_scheduler._s = None
+
+
+async def wait_ticket(ticket):
+    """ Queue position messages until the ticket is granted. """
+    while not ticket.granted:
+        yield {'type': 'html', 'val': f"⏳ waiting for execution, {ticket.position}. in the queue ⏳"}
+        await ticket.wait()
 
 
 @core.operator
@@ -186,6 +568,59 @@ async def stream_enum(n, s):
             yield (n, i)
 
 
+class _Inputs(object):
+    """ Items of the argument streams of a container. Every stream runs once
+    in the background, its items are read by the result cache lookup and
+    then by the container (read_inputs). """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.tasks = list()
+        self.ended = 0
+
+    def add(self, source):
+        self.tasks.append(asyncio.ensure_future(self.pump(source)))
+
+    async def pump(self, source):
+        try:
+            async with core.streamcontext(source) as streamer:
+                async for item in streamer:
+                    self.queue.put_nowait(item)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.queue.put_nowait(e)
+        finally:
+            self.queue.put_nowait(None)
+
+    def unread(self, items):
+        """ Return the items to the front of the queue. """
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        while not self.queue.empty():
+            queue.put_nowait(self.queue.get_nowait())
+        self.queue = queue
+
+    async def close(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+@core.operator
+async def read_inputs(inputs):
+    """ Items of the inputs until all the argument streams end. """
+    while inputs.ended < len(inputs.tasks):
+        item = await inputs.queue.get()
+        if item is None:
+            inputs.ended += 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
+
+
 
 @core.operator  # NOQA
 async def docker(ic, args):
@@ -199,28 +634,84 @@ async def docker(ic, args):
 
     docker_path = pathlib.Path(os.path.normpath(ic.path/args[0]))
 
-    dapi = None
+    inputs = _Inputs()
     try:
-        dapi = aiodocker.Docker()
-        con = await get_container(dapi, docker_path, ic.user)
-        if con is None:
-            return
-
-        logger.info(f"{con['id'][:12]}: created")
+        dapi = get_docker()
+        img, rebuilded = await get_image(dapi, docker_path, ic.user)
 
         ain = dict()
         aout = dict()
         for n, arg in enumerate(args[1:]):
             ain[n+1] = stream_enum(n+1, await my_stream.arg_stream(ic, ic.user, arg))
-
-        ws = await con.websocket(stdin=True, stdout=True, stderr=True, stream=True)
-        await con.start()
+            inputs.add(ain[n+1])
+
+        # replay the cached results as long as there are some for the inputs,
+        # the container is started on the first miss and gets the items read
+        # so far (the argument streams, e.g. nested containers, run just once)
+        results = get_result_cache()
+        if ain:
+            s = read_inputs(inputs)
+        else:
+            s = stream.just(None)
+
+        items = dict()
+        read = dict()
+        async with core.streamcontext(s) as streamer:
+            async for item in streamer:
+                if item is not None:
+                    items[item[0]] = item_json(item)
+                    read[item[0]] = item
+
+                if len(items) < len(ain):
+                    continue
+
+                try:
+                    msgs = results.get(result_key(img, items))
+                except KeyError:
+                    break
+
+                for msg in msgs:
+                    yield msg
+            else:
+                return
+
+        inputs.unread(read.values())
+
+        # the slot is held just while the container computes: from a new
+        # input to the first answer (a container waiting for its inputs,
+        # e.g. for a nested display, holds none), the author of the article
+        # goes first
+        scheduler = get_scheduler()
+        md = getattr(ic, 'md', None)
+        priority = 0 if md and md.article.current_revision.user_id == ic.user.pk else 1
+        ticket = None
+
+        con = None
+        attached = None
+        try:
+            con = await get_container_pool().checkout(img)
+            logger.info(f"{con['id'][:12]}: created")
+
+            attached = await attach_container(dapi, con)
+            ws = attached[1]
+            await con.start()
+        except BaseException:
+            if attached is not None:
+                await detach_container(*attached)
+            if con is not None:
+                await get_container_pool().release(con)
+            raise
 
         logger.debug(f"{con['id'][:12]}: started")
-        
+
         msgs_n = 0
         msgs_ts = time.time()
 
+        # messages produced for the current items, stored on '# WI-NATIVE cache'
+        # (the stdout since the items were sent, out[rec_from:])
+        rec = list()
+        rec_from = 0
+        cacheable = True
 
         try:
             restart = True
@@ -228,20 +719,30 @@ async def docker(ic, args):
                 restart = False
 
                 if ain:
-                    s = stream.merge(*list(ain.values()), websocket_reader(ws))
+                    s = stream.merge(read_inputs(inputs), websocket_reader(ws))
                 else:
                     s = stream.merge(websocket_reader(ws))
 
                     # if input is empty, send empty message to container
+                    if ticket is None:
+                        ticket = scheduler.enqueue(ic.user.pk, str(ic.path), priority)
+                        async for msg in wait_ticket(ticket):
+                            yield msg
+
                     logger.debug(f"{con['id'][:12]}: < []")
                     await ws.send_str(json.dumps(list())+"\n")
 
                 out = list()
+                rec_from = 0
                 async with core.streamcontext(s) as streamer:
                     async for item in streamer:
                         if item[0] == 'ws':
                             logger.debug(f"{con['id'][:12]}: > {item[1][:120]}")
 
+                            if ticket is not None:
+                                scheduler.release(ticket)
+                                ticket = None
+
                             msgs_n += 1
                             tdiff = time.time() - msgs_ts
 
@@ -254,10 +755,21 @@ async def docker(ic, args):
                             if m:
                                 if m.group(1) == 'clear':
                                     out = list()
-                                    yield {'type': None, 'val': ""}
+                                    rec_from = 0
+                                    msg = {'type': None, 'val': ""}
 
                                 elif m.group(1).startswith('progress'):
-                                    yield {'type': 'html', 'val': '<div class="progress"><div class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" aria-valuenow="50" aria-valuemin="0" aria-valuemax="100" style="width: 50%"></div></div>'}
+                                    msg = {'type': 'html', 'val': '<div class="progress"><div class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" aria-valuenow="50" aria-valuemin="0" aria-valuemax="100" style="width: 50%"></div></div>'}
+
+                                elif m.group(1) == 'cache':
+                                    if cacheable:
+                                        results.put(result_key(img, aout), list(rec))
+                                    continue
+
+                                elif m.group(1) == 'nocache':
+                                    cacheable = False
+                                    results.pop(result_key(img, aout))
+                                    continue
 
                                 else:
                                     try:
@@ -284,21 +796,23 @@ async def docker(ic, args):
 
                                             arg = pathlib.Path(mval)
                                             ain[mid] = stream_enum(mid, await my_stream.arg_stream(ic, u, arg))
+                                            inputs.add(ain[mid])
 
                                             restart = True
                                             break
-                                        elif msg['type'] in ['error']:
-                                            yield msg
-                                            break
-                                        else:
-                                            yield msg
                                     except json.JSONDecodeError as e:
                                         logger.warning(f"{con['id'][:12]}: broken msg: {e!s}")
                                         continue
 
                             else:
                                 out.append(item[1])
-                                yield {'type': 'stdout', 'val': "\n".join(out)}
+                                msg = {'type': 'stdout', 'val': "\n".join(out)}
+
+                            rec.append(msg if m else dict(msg, val="\n".join(out[rec_from:])))
+                            yield msg
+
+                            if msg.get('type') in ['error']:
+                                break
 
                         elif item[0] == 'err':
                             logger.debug(f"{con['id'][:12]}: !! " + ' '.join(str(item[1]).split())[:120])
@@ -306,7 +820,17 @@ async def docker(ic, args):
                             break
 
                         else:
-                            await send_item(ws, con, aout, item)
+                            if aout.get(item[0], None) == item_json(item):
+                                continue
+
+                            if ticket is None:
+                                ticket = scheduler.enqueue(ic.user.pk, str(ic.path), priority)
+                                async for msg in wait_ticket(ticket):
+                                    yield msg
+
+                            if await send_item(ws, con, aout, item):
+                                rec = list()
+                                rec_from = len(out)
 
         except GeneratorExit:
             pass
@@ -314,14 +838,11 @@ async def docker(ic, args):
         finally:
             logger.debug(f"{con['id'][:12]}: delete")
 
-            try:
-                await con.kill()
-                await con.delete()
-                pass
-            except Exception:
-                pass
-
-            ws.close()
+            # the websocket first, the delete must not wait for a connection
+            await detach_container(*attached)
+            await get_container_pool().release(con)
+            if ticket is not None:
+                scheduler.release(ticket)
 
     except MyException as e:
         yield {'type': 'error', 'val': f"⚠ {e!s} ⚠"}
@@ -330,7 +851,5 @@ async def docker(ic, args):
     except Exception as e:
         logger.exception(e)
         yield {'type': 'error', 'val': f"⚠ {e!s} ⚠"}
-
     finally:
-        if dapi:
-            await dapi.close()
+        await inputs.close()
@@ -49,11 +49,9 @@ def db_get_input_users(md, field, qfilter, items):
         else:
             qall |= q
 
-    q = qfilter & qall
+    owners = models.InputLatest.objects.filter(qfilter & qall).values('owner')
 
-    qs = models.Input.objects.filter(qfilter & qall).order_by('article', 'name', 'owner', '-created').distinct('article', 'name', 'owner')
-
-    return [i.owner for i in qs.all()], is_list
+    return list(User.objects.filter(pk__in=owners).order_by('pk')), is_list
 
 
 @core.operator
@@ -89,6 +87,9 @@ async def get(ic, args):
         if len(users) == 0:
             src += [my_stream.read_field(ic, ic.user, path)]
 
+        # the query of the owners is repeated when a new owner stores a value
+        src += [my_stream.new_owners(ic, md.article, field['name'])]
+
         s = stream.ziplatest(*src, partial=False)
         async with core.streamcontext(s) as streamer:
             async for i in streamer:
@@ -1,37 +1,70 @@
 from django.contrib.auth.models import User
 from aiostream import core, stream
 from django.template.loader import render_to_string
+from django.utils.html import escape
+import hashlib
 import logging
-from channels.db import database_sync_to_async
+import json
+import uuid
 import ipdb  # NOQA
 
 from .. import stream as my_stream
-from .. import models
+from .. import views
+from .. import misc
+from .. import settings
+from ..templatetags.wiki_forms_tags import UID_PLACEHOLDER, fill_uid
 
 logger = logging.getLogger(__name__)
 
 
-@database_sync_to_async
-def get_history(pk):
+def get_fragment_cache():
+    """ Rendered values by the pk (stored inputs are never changed) or by the
+    hash of the value. """
+    if get_fragment_cache._c is None:
+        get_fragment_cache._c = misc.LRUCache(settings.PPRINT_CACHE_SIZE)
+
+    return get_fragment_cache._c
+
+
+get_fragment_cache._c = None
+
+
+def render_value(val, uid, user):
+    """ The fragment of the value, the tab ids are replaced by the uid of the
+    cell (the same value can be shown in several cells of the page). """
+    if val.get('pk') is not None:
+        key = val['pk']
+    else:
+        key = hashlib.sha256(json.dumps(val, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    # the file URLs are valid just for the user
+    if val.get('type') in ['file', 'files']:
+        key = (key, user.pk)
+
     try:
-        i = models.Input.objects.get(pk=pk)
-    except models.Input.DoesNotExist:
-        logger.debug(f"pk={pk}")
-        return ""
+        html = get_fragment_cache().get(key)
+    except KeyError:
+        html = render_to_string(f"wiki/plugins/inputs/pprint.html", context=dict(val, uid=UID_PLACEHOLDER, viewer=user.pk))
+        get_fragment_cache().put(key, html)
 
-    out = ""
-    for v in models.Input.objects.filter(article=i.article, name=i.name, owner=i.owner):
-        val = my_stream.input_to_dict(v)
-        html = render_to_string(f"wiki/plugins/inputs/pprint.html", context=val)
-        out += f"<li>{v.name} {v.created} {v.author} ({v.pk}): {html}</li>"
+    return fill_uid(html, uid)
 
-    return f"<ul>{out}</ul>" if len(out) else ""
+
+def row_key(k):
+    if k is None:
+        return ''
+    elif isinstance(k, User):
+        return f"u{k.pk}"
+    else:
+        return f"s{k}"
 
 
 @core.operator  # NOQA
 async def pprint(ic, args):
     a = [await my_stream.arg_stream(ic, ic.user, arg) for arg in args]
     source = stream.ziplatest(*a, partial=False)
+    # stable ids of the cells, the unchanged cells are not sent again
+    prefix = f"dw-{uuid.uuid4().hex}"
 
     async with core.streamcontext(source) as streamer:
         async for item in streamer:
@@ -44,7 +77,7 @@ async def pprint(ic, args):
                     continue
 
                 if val.get('pk') is not None:
-                    info.append(await get_history(val['pk']))
+                    info.append(views.history_html(val['pk']))
 
                 if val['type'] is None:
                     pass
@@ -61,7 +94,7 @@ async def pprint(ic, args):
                         keys.insert(0, None)
                         vals[None] = [None] * len(item)
 
-                    vals[None][i] = render_to_string(f"wiki/plugins/inputs/pprint.html", context=val)
+                    vals[None][i] = render_value(val, f"{prefix}-{i}", ic.user)
 
                 elif val['type'] == 'user-list':
                     for u, v in val['val'].items():
@@ -69,7 +102,7 @@ async def pprint(ic, args):
                             keys.append(u)
                             vals[u] = [None] * len(item)
 
-                        vals[u][i] = render_to_string(f"wiki/plugins/inputs/pprint.html", context=v)
+                        vals[u][i] = render_value(v, f"{prefix}-{i}-{hashlib.sha1(row_key(u).encode('utf-8')).hexdigest()[:12]}", ic.user)
 
                 else:
                     logger.error(val)
@@ -79,29 +112,35 @@ async def pprint(ic, args):
                 yield None
                 continue
 
+            out = {'type': 'html'}
+
             if len(keys) == 1 and keys[0] is None:
                 html = " ".join(vals[keys[0]])
 
             else:
-                html = "<table>"
+                # the rows are also sent as cells, the consumer sends just
+                # the changed cells and rows to the client
+                rows = list()
 
                 for k in keys:
-                    html += "<tr><th>"
+                    th = "<th>"
                     if k is None:
-                        html += "&nbsp;"
+                        th += "&nbsp;"
                     elif isinstance(k, User):
-                        html += f"{k.first_name} {k.last_name}"
+                        th += f"{k.first_name} {k.last_name}"
                     else:
-                        html += str(k)
-                    html += "</th>"
+                        th += str(k)
+                    th += "</th>"
 
-                    for v in vals[k]:
-                        html += f"<td>{v!s}</td>"
+                    tds = [str(v) for v in vals[k]]
+                    key = row_key(k)
+                    rows.append([key, f'<tr data-key="{escape(key)}">{th}' + "".join(f"<td>{v}</td>" for v in tds) + "</tr>", tds])
 
-                    html += "</tr>"
-                html += "</table>"
+                html = '<table class="dw-table">' + "".join(r[1] for r in rows) + "</table>"
+                out['cells'] = {'rows': rows, 'info': "".join(info)}
 
             if info:
                 html = render_to_string("wiki/plugins/inputs/pprint_full.html", context={'html': html, 'info': "".join(info)})
 
-            yield {'type': 'html', 'val': html}
+            out['val'] = html
+            yield out
@@ -3,10 +3,14 @@ import markdown
 from django.template.loader import render_to_string
 import pyparsing as pp
 from pathlib import Path
+import functools
 import ipdb  # NOQA
 import logging
+import copy
+import re
 
 from .. import misc
+from .. import settings
 
 logger = logging.getLogger(__name__)
 pp.ParserElement.setDefaultWhitespaceChars(' \t')
@@ -38,6 +42,54 @@ pdisplay = (pp.Literal('[').suppress() +  # NOQA
 
 pparser = pinput ^ pdisplay
 
+# every input/display tag starts with this, the grammar is tried just here
+ptag_re = re.compile(r'\[[ \t]*(?:input|display)', re.IGNORECASE)
+
+
+def scan(doc):
+    """ Same as pparser.scanString(doc), but the grammar is tried just at the
+    candidate offsets found by ptag_re instead of at every character. """
+
+    pparser.streamline()
+    pp.ParserElement.resetCache()
+
+    loc = 0
+    for m in ptag_re.finditer(doc):
+        start = m.start()
+        if start < loc:
+            continue
+
+        try:
+            end, t = pparser._parse(doc, start)
+        except pp.ParseBaseException:
+            continue
+
+        yield t, start, end
+        loc = end
+
+
+@functools.lru_cache(maxsize=settings.PARSE_CACHE_SIZE)
+def parse(doc):
+    """ Return user independent (start, end, field) of all the tags in the
+    doc. The result is shared, use a copy of the field. """
+
+    out = list()
+    for t, start, end in scan(doc):
+        field = t.asDict()
+        field['src'] = doc[(start+1):(end-1)]
+
+        if field['cmd'] == 'input':
+            if type(field['args']) == list:
+                assert len(field['args']) == 0
+                field['args'] = dict()
+
+            if 'type' not in field['args']:
+                field['args']['type'] = 'text'
+
+        out.append((start, end, field))
+
+    return tuple(out)
+
 
 class InputExtension(markdown.Extension):
     """ Input plugin markdown extension for django-wiki. """
@@ -60,6 +112,8 @@ class InputPreprocessor(markdown.preprocessors.Preprocessor):
         if self.markdown:
             self.markdown.display_fields = self.display_fields
             self.markdown.input_fields = self.input_fields
+            # set by run(), which is skipped for an empty article
+            self.markdown.parsed_fields = ()
 
     # [f"{u.first_name} {u.last_name} <{u.email}>" for u in usrs]
     def expand_user_list(self, val):
@@ -108,51 +162,60 @@ class InputPreprocessor(markdown.preprocessors.Preprocessor):
             return v == self.markdown.user.username or v == self.markdown.user.email
 
 
+    def add_field(self, field):
+        """ Add copy of the parsed field with the user permissions applied. """
+        field = copy.deepcopy(field)
+        field['user'] = self.markdown.user
+
+        if field['cmd'] == 'display':
+            field['id'] = len(self.display_fields)
+            self.display_fields.append(field)
+
+        elif field['cmd'] == 'input':
+            if field['args']['type'] == 'select-user':
+                self.parse_select_user(field['args'])
+
+            if not self.markdown.article.can_read(self.markdown.user):
+                field['can_read'] = False
+            elif self.can_field(field, 'can_read') is False:
+                field['can_read'] = False
+            else:
+                field['can_read'] = True
+
+            if not field['can_read'] or self.markdown.article.current_revision.locked:
+                field['can_write'] = False
+            else:
+                field['can_write'] = self.can_field(field, 'can_write')
+
+            self.input_fields[field['name']] = field
+
+        return field
+
+
+    def add_fields(self, parsed):
+        for start, end, field in parsed:
+            self.add_field(field)
+
+
     def run(self, lines):
         doc = '\n'.join(lines)
 
+        parsed = parse(doc)
+        if self.markdown:
+            self.markdown.parsed_fields = parsed
+
         shift_n = 0
 
-        for t, start, end in pparser.scanString(doc):
-            field = t.asDict()
-            field['src'] = doc[(start+shift_n+1):(end+shift_n-1)]
-            field['user'] = self.markdown.user
+        for start, end, field in parsed:
+            field = self.add_field(field)
 
             if field['cmd'] == 'display':
-                field['id'] = len(self.display_fields)
-                self.display_fields.append(field)
-
                 if self.markdown.preview:
                     html = render_to_string(f"wiki/plugins/inputs/preview.html", context=field)
                 else:
                     html = render_to_string(f"wiki/plugins/inputs/display.html", context=field)
 
             elif field['cmd'] == 'input':
-
-                if type(field['args']) == list:
-                    assert len(field['args']) == 0
-                    field['args'] = dict()
-
-                if 'type' not in field['args']:
-                    field['args']['type'] = 'text'
-
-                if field['args']['type'] == 'select-user':
-                    self.parse_select_user(field['args'])
-
-                if not self.markdown.article.can_read(self.markdown.user):
-                    field['can_read'] = False
-                elif self.can_field(field, 'can_read') is False:
-                    field['can_read'] = False
-                else:
-                    field['can_read'] = True
-
-                if not field['can_read'] or self.markdown.article.current_revision.locked:
-                    field['can_write'] = False
-                else:
-                    field['can_write'] = self.can_field(field, 'can_write')
-
-                self.input_fields[field['name']] = field
-
                 if field['can_read']:
                     if self.markdown.preview:
                         html = render_to_string(f"wiki/plugins/inputs/preview.html", context=field)
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_latest(apps, schema_editor):
+    Input = apps.get_model('django_wiki_inputs', 'Input')
+    InputLatest = apps.get_model('django_wiki_inputs', 'InputLatest')
+
+    batch = list()
+    last_key, last_pk = None, None
+
+    qs = Input.objects.order_by('article', 'name', 'owner', 'created').values_list('pk', 'article_id', 'name', 'owner_id')
+    for pk, article_id, name, owner_id in qs.iterator():
+        key = (article_id, name, owner_id)
+
+        if last_key is not None and key != last_key:
+            batch.append(InputLatest(article_id=last_key[0], name=last_key[1], owner_id=last_key[2], input_id=last_pk))
+
+            if len(batch) >= 1000:
+                InputLatest.objects.bulk_create(batch)
+                batch = list()
+
+        last_key, last_pk = key, pk
+
+    if last_key is not None:
+        batch.append(InputLatest(article_id=last_key[0], name=last_key[1], owner_id=last_key[2], input_id=last_pk))
+
+    InputLatest.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wiki', '0002_urlpath_moved_to'),
+        ('django_wiki_inputs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InputLatest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=28)),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wiki.Article', verbose_name='article')),
+                ('input', models.OneToOneField(help_text='the latest input.', on_delete=django.db.models.deletion.CASCADE, related_name='latest', to='django_wiki_inputs.Input')),
+                ('owner', models.ForeignKey(help_text='the owner of the input.', on_delete=django.db.models.deletion.CASCADE, related_name='input_latest_owner', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Latest input',
+                'verbose_name_plural': 'Latest inputs',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='inputlatest',
+            unique_together={('article', 'name', 'owner')},
+        ),
+        migrations.RunPython(backfill_latest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_wiki_inputs', '0002_inputlatest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='input',
+            name='article',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='wiki.Article', verbose_name='article'),
+        ),
+        migrations.AlterField(
+            model_name='inputlatest',
+            name='article',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='wiki.Article', verbose_name='article'),
+        ),
+        migrations.AlterField(
+            model_name='inputlatest',
+            name='owner',
+            field=models.ForeignKey(db_index=False, help_text='the owner of the input.', on_delete=django.db.models.deletion.CASCADE, related_name='input_latest_owner', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='inputlatest',
+            index=models.Index(fields=['owner', 'article', 'name'], name='dwi_inputlatest_owner_idx'),
+        ),
+    ]
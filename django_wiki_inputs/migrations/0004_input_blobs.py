@@ -0,0 +1,48 @@
+from django.db import migrations
+import json
+
+
+def update_files(apps, fn):
+    Input = apps.get_model('django_wiki_inputs', 'Input')
+
+    batch = list()
+    qs = Input.objects.filter(val__contains='"type": "file').only('pk', 'val')
+    for i in qs.iterator():
+        try:
+            val = json.loads(i.val)
+        except ValueError:
+            continue
+
+        if not isinstance(val, dict) or val.get('type') not in ['file', 'files'] or not isinstance(val.get('val'), list):
+            continue
+
+        val['val'] = fn(val['val'])
+        i.val = json.dumps(val)
+        batch.append(i)
+
+        if len(batch) >= 1000:
+            Input.objects.bulk_update(batch, ['val'])
+            batch = list()
+
+    Input.objects.bulk_update(batch, ['val'])
+
+
+def extract_blobs(apps, schema_editor):
+    from django_wiki_inputs import blobs
+    update_files(apps, blobs.store_files)
+
+
+def inline_blobs(apps, schema_editor):
+    from django_wiki_inputs import blobs
+    update_files(apps, blobs.inline_files)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_wiki_inputs', '0003_input_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(extract_blobs, inline_blobs),
+    ]
@@ -3,12 +3,18 @@ from django.contrib.auth.models import User
 from wiki.models import URLPath
 from wiki.core.markdown import ArticleMarkdown
 from channels.db import database_sync_to_async
+import collections
+import copy
 import logging
 import pathlib
 import asyncio
+import weakref
+import time
 import re
 import os
 
+from . import settings
+
 import ipdb # NOQA
 
 logger = logging.getLogger(__name__)
@@ -22,9 +28,19 @@ def db_get_article(path):
         return None
 
 @database_sync_to_async
-def db_get_article_markdown(article, user):
-    md = ArticleMarkdown(article, preview=True, user=user)
-    md.convert(article.current_revision.content)
+def db_get_article_markdown(article, user, base=None):
+    if base is None:
+        md = ArticleMarkdown(article, preview=True, user=user)
+        md.convert(article.current_revision.content)
+        return md
+
+    # the revision was already rendered for another user, re-use its parsed
+    # fields and apply just the permissions of this user
+    from .mdx.input import InputPreprocessor
+
+    md = copy.copy(base)
+    md.user = user
+    InputPreprocessor(md).add_fields(base.parsed_fields)
     return md
 
 
@@ -71,11 +87,129 @@ def normpath(ic, path):
     return pathlib.Path(os.path.normpath(os.path.join(ic.path, str(path))))
 
 
+class LRUCache(object):
+    """Size and age bounded LRU cache, counts hits, misses and evictions. The
+    size of an entry is given by sizeof (1 by default)."""
+
+    def __init__(self, max_size, max_age=None, stats=None, sizeof=None):
+        self.data = collections.OrderedDict()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.stats = collections.Counter() if stats is None else stats
+        self.sizeof = sizeof
+        self.size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        try:
+            ts, val, size = self.data[key]
+        except KeyError:
+            self.stats['misses'] += 1
+            raise
+
+        now = time.monotonic()
+        if self.max_age is not None and now - ts > self.max_age:
+            self.remove(key)
+            self.stats['evictions'] += 1
+            self.stats['misses'] += 1
+            raise KeyError(key)
+
+        self.data[key] = (now, val, size)
+        self.data.move_to_end(key)
+        self.stats['hits'] += 1
+        return val
+
+    def put(self, key, val):
+        size = 1 if self.sizeof is None else self.sizeof(val)
+        if size > self.max_size:
+            return
+
+        self.remove(key)
+        self.data[key] = (time.monotonic(), val, size)
+        self.size += size
+        self.expire()
+
+    def remove(self, key):
+        ts, val, size = self.data.pop(key, (None, None, 0))
+        self.size -= size
+        return val
+
+    def pop(self, key, default=None):
+        if key not in self.data:
+            return default
+
+        return self.remove(key)
+
+    def drop(self, pred):
+        for key in [k for k in self.data if pred(k)]:
+            self.remove(key)
+            self.stats['evictions'] += 1
+
+    def expire(self):
+        now = time.monotonic()
+
+        # entries are ordered by the last access, the oldest is the first one
+        while self.data:
+            key, (ts, val, size) = next(iter(self.data.items()))
+            if self.size <= self.max_size and (self.max_age is None or now - ts <= self.max_age):
+                break
+
+            self.remove(key)
+            self.stats['evictions'] += 1
+
+
+# owner of the condition (and the channel layer group) notified on the first
+# stored value of every owner of the field, get() looks for the new owners
+NEW_OWNER = 'owners'
+
+
+class InputCondition(asyncio.Condition):
+    """ Condition notified on a field change, carries the new value. """
+    latest = None
+
+
 class _MarkdownFactory(object):
     def __init__(self):
-        self.cache = dict()
-        self.input_cv = dict()
-        self.render_lock = asyncio.Lock()
+        self.stats = collections.Counter()
+        self.cache = LRUCache(settings.MARKDOWN_CACHE_SIZE, settings.MARKDOWN_CACHE_AGE, self.stats)
+        self.revisions = dict()
+        self.rendering = dict()
+
+        # (article, field, owner) conditions are referenced by the readers
+        # waiting on them, they disappear together with the last reader
+        self.input_cv = weakref.WeakValueDictionary()
+
+        # every consumer subscribed to a change gets its own copy of the
+        # event, just the first one wakes the local waiters
+        self.events = LRUCache(1024)
+
+    def drop_superseded(self, article, cid):
+        if self.revisions.get(article.pk, cid) != cid:
+            logger.debug(f"{article}: drop superseded revision {self.revisions[article.pk]}")
+            self.cache.drop(lambda k: k[0] == article.pk and k[1] != cid)
+
+        self.revisions[article.pk] = cid
+
+    async def render(self, path, article, user):
+        cid = article.current_revision.pk
+
+        try:
+            base = self.cache.get((article.pk, cid, None))
+        except KeyError:
+            base = None
+
+        logger.debug(f"{user}@{path}: render current version")
+        md = await db_get_article_markdown(article, user, base)
+        if base is None:
+            self.cache.put((article.pk, cid, None), md)
+
+        self.cache.put((article.pk, cid, user.pk), md)
+        return md
 
     async def get_markdown(self, path, user):
         article = await db_get_article(path)
@@ -84,24 +218,48 @@ class _MarkdownFactory(object):
             return None
 
         cid = article.current_revision.pk
-        async with self.render_lock:
-            try:
-                return self.cache[(cid, user.pk)]
-            except KeyError:
-                pass
-
-            logger.debug(f"{user}@{path}: render current version")
-            md = await db_get_article_markdown(article, user)
-
-            for key, field in md.input_fields.items():
-                try:
-                    field['cv'] = self.input_cv[(cid, key)]
-                except KeyError:
-                    field['cv'] = asyncio.Condition()
-                    self.input_cv[(cid, key)] = field['cv']
-
-            self.cache[(cid, user.pk)] = md
-            return md
+        self.drop_superseded(article, cid)
+
+        key = (article.pk, cid, user.pk)
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            pass
+
+        # concurrent requests for the same revision and user share one render,
+        # renders of other articles (or users) run in parallel
+        fut = self.rendering.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self.render(path, article, user))
+            fut.add_done_callback(lambda f: self.rendering.pop(key, None))
+            self.rendering[key] = fut
+
+        return await asyncio.shield(fut)
+
+    def get_cv(self, article_pk, name, owner_pk):
+        """ Condition notified on change of the owner's article field. """
+        try:
+            return self.input_cv[(article_pk, name, owner_pk)]
+        except KeyError:
+            cv = InputCondition()
+            self.input_cv[(article_pk, name, owner_pk)] = cv
+            return cv
+
+    async def notify(self, article_pk, name, owner_pk, val=None, event=None):
+        """ Wake the local readers of the owner's article field, val is the new
+        value (if known). """
+        if event is not None:
+            if event in self.events:
+                return
+            self.events.put(event, True)
+
+        cv = self.input_cv.get((article_pk, name, owner_pk))
+        if cv is None:
+            return
+
+        async with cv:
+            cv.latest = val
+            cv.notify_all()
 
 
 def get_markdown_factory():
@@ -10,7 +10,8 @@ logger = logging.getLogger(__name__)
 
 
 class Input(models.Model):
-    article = models.ForeignKey(Article, on_delete=models.CASCADE, verbose_name=_('article'))
+    # indexed by the unique_together (article, name, owner, created)
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, verbose_name=_('article'), db_index=False)
     name = models.CharField(max_length=28)
 
     created = models.DateTimeField()
@@ -37,3 +38,30 @@ class Input(models.Model):
             "" if self.owner is None else "@{}".format(self.owner),
             self.val,
             "..." if len(self.val) > 60 else "")
+
+
+class InputLatest(models.Model):
+    """ Pointer to the latest Input of the (article, name, owner), maintained
+    together with the Input history. """
+
+    # indexed by the unique_together (article, name, owner) and by the
+    # (owner, article, name) index used for the owner's group lookups
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, verbose_name=_('article'), db_index=False)
+    name = models.CharField(max_length=28)
+
+    owner = models.ForeignKey(User, help_text='the owner of the input.', related_name='input_latest_owner', db_index=False, on_delete=models.CASCADE)
+    input = models.OneToOneField(Input, help_text='the latest input.', related_name='latest', on_delete=models.CASCADE)
+
+
+    class Meta:
+        verbose_name = _('Latest input')
+        verbose_name_plural = _('Latest inputs')
+        unique_together = ('article', 'name', 'owner')
+        indexes = [
+            models.Index(fields=['owner', 'article', 'name'], name='dwi_inputlatest_owner_idx'),
+        ]
+
+
+
+    def __str__(self):
+        return str(self.input)
@@ -1,3 +1,65 @@
-# from django.conf import settings as django_settings
+from django.conf import settings as django_settings
 
 SLUG = 'inputs'
+
+# max. number of rendered (revision, user) markdowns kept by the markdown factory
+MARKDOWN_CACHE_SIZE = getattr(django_settings, 'WIKI_INPUTS_MARKDOWN_CACHE_SIZE', 1000)
+
+# drop rendered markdowns not used for this number of seconds
+MARKDOWN_CACHE_AGE = getattr(django_settings, 'WIKI_INPUTS_MARKDOWN_CACHE_AGE', 3600)
+
+# max. number of parsed article texts, the parse is shared by all the users
+PARSE_CACHE_SIZE = getattr(django_settings, 'WIKI_INPUTS_PARSE_CACHE_SIZE', 256)
+
+# store an input value after this number of seconds without a change, the
+# readers are notified immediately (0 stores every value immediately)
+WRITE_DELAY = getattr(django_settings, 'WIKI_INPUTS_WRITE_DELAY', 2)
+
+# number of attempts to store a delayed input value, the failed value is
+# retried after WRITE_DELAY seconds
+WRITE_RETRIES = getattr(django_settings, 'WIKI_INPUTS_WRITE_RETRIES', 5)
+
+# number of pre-created containers per image, the pool grows up to the max.
+# on demand and the containers idle for DOCKER_POOL_TTL seconds are deleted
+DOCKER_POOL_MIN = getattr(django_settings, 'WIKI_INPUTS_DOCKER_POOL_MIN', 1)
+DOCKER_POOL_MAX = getattr(django_settings, 'WIKI_INPUTS_DOCKER_POOL_MAX', 8)
+DOCKER_POOL_TTL = getattr(django_settings, 'WIKI_INPUTS_DOCKER_POOL_TTL', 600)
+
+# results of the container runs marked cacheable by '# WI-NATIVE cache', the
+# total size (bytes of JSON) and age (seconds) are bounded
+DOCKER_RESULT_CACHE_BYTES = getattr(django_settings, 'WIKI_INPUTS_DOCKER_RESULT_CACHE_BYTES', 64 * 1024 * 1024)
+DOCKER_RESULT_CACHE_AGE = getattr(django_settings, 'WIKI_INPUTS_DOCKER_RESULT_CACHE_AGE', 3600)
+
+# max. number of computing containers (from a new input, or the start of a
+# container without inputs, to the first answer), in total, per user and per
+# article (the page with the display), 0 is no limit
+DOCKER_MAX_RUNNING = getattr(django_settings, 'WIKI_INPUTS_DOCKER_MAX_RUNNING', 64)
+DOCKER_MAX_RUNNING_USER = getattr(django_settings, 'WIKI_INPUTS_DOCKER_MAX_RUNNING_USER', 8)
+DOCKER_MAX_RUNNING_ARTICLE = getattr(django_settings, 'WIKI_INPUTS_DOCKER_MAX_RUNNING_ARTICLE', 0)
+
+# max. size (bytes) of all the files uploaded to a files input at once
+UPLOAD_MAX_SIZE = getattr(django_settings, 'WIKI_INPUTS_UPLOAD_MAX_SIZE', 16 * 1024 * 1024)
+
+# store of the file input contents (dotted path of a blobs.BlobStore class),
+# the contents are deduplicated by their sha256 digest
+BLOB_STORE = getattr(django_settings, 'WIKI_INPUTS_BLOB_STORE', 'django_wiki_inputs.blobs.FileSystemBlobStore')
+
+# directory of the FileSystemBlobStore, it must be set and must not be served
+# by the web server (the files are served just by views.file_view)
+BLOB_ROOT = getattr(django_settings, 'WIKI_INPUTS_BLOB_ROOT', None)
+
+# number of the versions on a page of the value history and the max. number
+# of the rendered versions kept in the memory
+HISTORY_PAGE_SIZE = getattr(django_settings, 'WIKI_INPUTS_HISTORY_PAGE_SIZE', 20)
+HISTORY_CACHE_SIZE = getattr(django_settings, 'WIKI_INPUTS_HISTORY_CACHE_SIZE', 4096)
+
+# max. number of the rendered values kept by pprint
+PPRINT_CACHE_SIZE = getattr(django_settings, 'WIKI_INPUTS_PPRINT_CACHE_SIZE', 4096)
+
+# the websocket messages shorter than this are not compressed (if the client
+# asks for the compression)
+COMPRESS_MIN_SIZE = getattr(django_settings, 'WIKI_INPUTS_COMPRESS_MIN_SIZE', 1024)
+
+# min. interval (seconds) between the sends to a client, only the latest
+# message of every input/display is sent
+SEND_INTERVAL = getattr(django_settings, 'WIKI_INPUTS_SEND_INTERVAL', 0.1)
@@ -1,4 +1,6 @@
 var webSocketBridge;
+var uploads = {};
+var UPLOAD_CHUNK = 64 * 1024;
 
 $.ajaxSetup({
   beforeSend: function(xhr, settings) {
@@ -10,6 +12,109 @@ $.ajaxSetup({
 })
 
 
+function decodeFrame(buf) {
+  /* the first byte are flags: 1 - msgpack (JSON otherwise), 2 - zlib */
+  var flags = new Uint8Array(buf, 0, 1)[0];
+  var data = buf.slice(1);
+
+  if (flags & 2) {
+    var ds = new DecompressionStream('deflate');
+    data = new Response(new Blob([data]).stream().pipeThrough(ds)).arrayBuffer();
+  }
+
+  return Promise.resolve(data).then(function(data) {
+    if (flags & 1) {
+      return msgpackDecode(new Uint8Array(data));
+    }
+    return JSON.parse(new TextDecoder().decode(data));
+  });
+}
+
+
+function msgpackDecode(buf) {
+  var view = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+  var pos = 0;
+
+  function str(n) {
+    var s = new TextDecoder().decode(buf.subarray(pos, pos + n));
+    pos += n;
+    return s;
+  }
+
+  function bin(n) {
+    var b = buf.slice(pos, pos + n);
+    pos += n;
+    return b;
+  }
+
+  function array(n) {
+    var a = [];
+    for (var i = 0; i < n; i++) {
+      a.push(decode());
+    }
+    return a;
+  }
+
+  function map(n) {
+    var m = {};
+    for (var i = 0; i < n; i++) {
+      var k = decode();
+      m[k] = decode();
+    }
+    return m;
+  }
+
+  function uint(n) {
+    var v = 0;
+    for (var i = 0; i < n; i++) {
+      v = v * 256 + buf[pos++];
+    }
+    return v;
+  }
+
+  function decode() {
+    var b = buf[pos++];
+    var v;
+
+    if (b <= 0x7f) return b;
+    if (b <= 0x8f) return map(b & 0x0f);
+    if (b <= 0x9f) return array(b & 0x0f);
+    if (b <= 0xbf) return str(b & 0x1f);
+    if (b >= 0xe0) return b - 0x100;
+
+    switch (b) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return bin(uint(1));
+      case 0xc5: return bin(uint(2));
+      case 0xc6: return bin(uint(4));
+      case 0xca: v = view.getFloat32(pos); pos += 4; return v;
+      case 0xcb: v = view.getFloat64(pos); pos += 8; return v;
+      case 0xcc: return uint(1);
+      case 0xcd: return uint(2);
+      case 0xce: return uint(4);
+      case 0xcf: return uint(8);
+      case 0xd0: v = view.getInt8(pos); pos += 1; return v;
+      case 0xd1: v = view.getInt16(pos); pos += 2; return v;
+      case 0xd2: v = view.getInt32(pos); pos += 4; return v;
+      case 0xd3: v = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return v;
+      case 0xd9: return str(uint(1));
+      case 0xda: return str(uint(2));
+      case 0xdb: return str(uint(4));
+      case 0xdc: return array(uint(2));
+      case 0xdd: return array(uint(4));
+      case 0xde: return map(uint(2));
+      case 0xdf: return map(uint(4));
+    }
+
+    throw new Error('msgpack: unsupported type ' + b);
+  }
+
+  return decode();
+}
+
+
 function receiveMessage(msg) {
   var type = String(msg['type']);
   var fid = msg['id'];
@@ -30,22 +135,237 @@ function receiveMessage(msg) {
   }
 
   if (type == 'display') {
+    if (msg['patch'] !== undefined) {
+      if (!applyPatch(fid, msg['patch'])) {
+        webSocketBridge.send({resync: fid});
+      }
+      return;
+    }
+
     $('span[data-id=' + fid + '].dw-input')
       .html(msg['val'] ? msg['val']['val'] : "");
 
     $('[data-toggle="popover"]').popover();
+    loadFiles($('span[data-id=' + fid + '].dw-input .tab-pane.active').not('.modal .tab-pane'));
+  }
+
+  if (type == 'upload') {
+    var uid = msg['uid'];
+    var u = uploads[uid];
+
+    if (u === undefined) {
+      return;
+    }
+
+    if (msg['error'] !== undefined || msg['done']) {
+      delete uploads[uid];
+      return;
+    }
+
+    if (msg['offsets'] !== undefined) {
+      u.offsets = msg['offsets'];
+    } else {
+      u.offsets[msg['file']] = msg['offset'];
+    }
+
+    sendChunk(uid);
   }
 
 }
 
 
+function applyPatch(fid, patch) {
+  /* apply the changes of the display table, false if the table does not
+   * match and the whole display has to be sent again */
+  var t = $('span[data-id=' + fid + '].dw-input table.dw-table');
+  if (t.length != 1) {
+    return false;
+  }
+
+  var table = t[0];
+  var body = table.tBodies.length ? table.tBodies[0] : table;
+
+  function findRow(key) {
+    for (var i = 0; i < table.rows.length; i++) {
+      if (table.rows[i].getAttribute('data-key') === key) {
+        return $(table.rows[i]);
+      }
+    }
+    return null;
+  }
+
+  for (var i = 0; i < patch.length; i++) {
+    var p = patch[i];
+    var r = findRow(p[1]);
+
+    if (p[0] == 'del') {
+      if (r === null) {
+        return false;
+      }
+      r.remove();
+
+    } else if (p[0] == 'row') {
+      var e = $(p[3]);
+
+      if (r !== null) {
+        return false;
+      }
+
+      if (p[2] < table.rows.length) {
+        e.insertBefore(table.rows[p[2]]);
+      } else {
+        e.appendTo(body);
+      }
+      loadFiles(e.find('.tab-pane.active'));
+
+    } else if (p[0] == 'cell') {
+      var td = r === null ? $() : r.children('td').eq(p[2]);
+
+      if (td.length != 1) {
+        return false;
+      }
+      td.html(p[3]);
+      loadFiles(td.find('.tab-pane.active'));
+
+    } else {
+      return false;
+    }
+  }
+
+  $('[data-toggle="popover"]').popover();
+  return true;
+}
+
+
+function loadFiles(e) {
+  /* the file contents are loaded when their tab is shown */
+  e.find('.dw-file[data-src]').addBack('.dw-file[data-src]').each(function() {
+    var f = $(this);
+
+    f.load(f.attr('data-src'));
+    f.removeAttr('data-src');
+  });
+}
+
+
+$(document).on('shown.bs.tab', 'a[data-toggle="tab"]', function(ev) {
+  loadFiles($($(ev.target).attr('href')));
+});
+
+
+function loadHistory(e) {
+  /* the history of the value is loaded when its modal is shown */
+  e.find('.dw-history[data-src]').each(function() {
+    var h = $(this);
+
+    h.load(h.attr('data-src'), function() {
+      loadFiles(h.find('.tab-pane.active'));
+    });
+    h.removeAttr('data-src');
+  });
+}
+
+
+$(document).on('shown.bs.modal', '.modal', function(ev) {
+  loadFiles($(ev.target).find('.tab-pane.active').not('.dw-history .tab-pane'));
+  loadHistory($(ev.target));
+});
+
+
+$(document).on('click', 'a.dw-history-more[data-src]', function(ev) {
+  var a = $(this);
+
+  ev.preventDefault();
+  $.get(a.attr('data-src'), function(html) {
+    var e = $('<div/>').html(html);
+
+    loadFiles(e.find('.tab-pane.active'));
+    a.replaceWith(e.contents());
+  });
+  a.removeAttr('data-src');
+});
+
+
+function sendChunk(uid) {
+  /* send the next chunk of the first unfinished file, the next one is sent
+   * after the server acknowledges this one */
+  var u = uploads[uid];
+
+  for (var i = 0; i < u.files.length; i++) {
+    var f = u.files[i];
+    var offset = u.offsets[i];
+
+    if (offset < f.size) {
+      var reader = new FileReader();
+
+      reader.onload = function(ev) {
+        var hdr = new TextEncoder().encode(JSON.stringify({uid: uid, file: i, offset: offset}));
+        var chunk = new Uint8Array(ev.target.result);
+        var data = new Uint8Array(4 + hdr.length + chunk.length);
+
+        new DataView(data.buffer).setUint32(0, hdr.length);
+        data.set(hdr, 4);
+        data.set(chunk, 4 + hdr.length);
+        webSocketBridge.socket.send(data.buffer);
+      }
+      reader.readAsArrayBuffer(f.slice(offset, offset + UPLOAD_CHUNK));
+      return;
+    }
+  }
+}
+
+
+function startUpload(uid) {
+  var u = uploads[uid];
+
+  webSocketBridge.send({
+    upload: 'start',
+    uid: uid,
+    id: u.id,
+    files: u.files.map(function(f) {
+      return {name: f.name, size: f.size, type: f.type};
+    })
+  });
+}
+
+
 
 $(document).ready(function() {
   if (!window.location.href.endsWith("/_preview/")) {
     webSocketBridge = new channels.WebSocketBridge();
-    webSocketBridge.connect('/ws/django-wiki-inputs?path=' + location.pathname);
+    var qs = '?path=' + location.pathname + '&enc=msgpack';
+    if (typeof DecompressionStream !== 'undefined') {
+      qs += '&compress=zlib';
+    }
+
+    webSocketBridge.connect('/ws/django-wiki-inputs' + qs);
     webSocketBridge.listen(receiveMessage)
 
+    /* the text frames are JSON (handled by the bridge), the binary ones
+     * are decoded here, in the order of arrival */
+    var onmessage = webSocketBridge.socket.onmessage;
+    var frames = Promise.resolve();
+
+    webSocketBridge.socket.onmessage = function(ev) {
+      if (typeof ev.data === 'string') {
+        return onmessage(ev);
+      }
+
+      var data = ev.data;
+      frames = frames.then(function() {
+        return data instanceof ArrayBuffer ? data : new Response(data).arrayBuffer();
+      }).then(decodeFrame).then(receiveMessage).catch(function(e) {
+        console.error(e);
+      });
+    };
+
+    /* resume the unfinished uploads after a reconnect */
+    webSocketBridge.socket.addEventListener('open', function() {
+      for (var uid in uploads) {
+        startUpload(uid);
+      }
+    });
+
     $('[data-toggle="popover"]').popover();
   }
 })
@@ -57,36 +377,14 @@ function sendUpdate(e) {
     var type = e.attr('type');
 
     if (type == 'file') {
-        var n = e.context.files.length;
-        var data = [];
-
-        for (var i = 0; i < n; i++) {
-            var reader = new FileReader();
-            //reader._file = ev.target.files[i];
-            reader._file = e.context.files[i];
-
-            reader.onload = function(ev2) {
-                if (ev2.target.result == 'data:') {
-                    /* empty file */
-                    var content = "";
-                    var type = "application/x-empty";
-                } else {
-                    var r = ev2.target.result.split(';base64,');
-                    var type = r[0].slice(5);
-                    var content = r[r.length - 1];
-                }
-
-                data.push({name: ev2.target._file.name,
-                          size: ev2.target._file.size,
-                          type: type,
-                          content: content});
-
-                if (data.length == n) {
-                    webSocketBridge.send({id: fid, val: data});
-                }
-            }
-            reader.readAsDataURL(reader._file);
-        }
+        var uid = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+        uploads[uid] = {
+          id: fid,
+          files: Array.prototype.slice.call(e.context.files),
+          offsets: []
+        };
+        startUpload(uid);
     } else {
         webSocketBridge.send({id: fid, val: e.val()});
     }
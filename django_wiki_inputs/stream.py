@@ -1,6 +1,7 @@
 from channels.db import database_sync_to_async
 from aiostream import stream, core
 import logging
+import asyncio
 import json
 import pathlib
 
@@ -30,10 +31,10 @@ def input_to_dict(val):
 
 @database_sync_to_async
 def db_get_input(article, name, user, curr_pk=None):
-    val = models.Input.objects.filter(
+    val = models.InputLatest.objects.select_related('input', 'input__author').get(
         article=article,
         owner=user,
-        name=name).latest()
+        name=name).input
 
     if curr_pk == val.pk:
         return None
@@ -94,22 +95,189 @@ async def read_field(ic, user, path):
         yield curr
         return
 
-    while True:
-        if field['args'].get('dummy', False):
+    # dummy values live just in the consumer, they are not owned by anybody
+    if field['args'].get('dummy', False):
+        cv = misc.get_markdown_factory().get_cv(md.article.pk, name, None)
+        while True:
             if ic.md == md:
                 curr = ic.dummy_val.get(name, curr)
-        else:
-            try:
-                c = await db_get_input(md.article, name, user, curr['pk'])
-                if c is not None:
-                    curr = c
-            except models.Input.DoesNotExist:
-                pass
 
-        yield curr
+            yield curr
+
+            async with cv:
+                await cv.wait()
+
+    await ic.subscribe(md.article, name, user.pk)
+
+    # the stored value is read once for all the readers, this reader has
+    # passed the permission checks above
+    async with get_input_hub().subscribe(md.article, name, user) as feed:
+        version = 0
+        while True:
+            async with feed.cv:
+                await feed.cv.wait_for(lambda: feed.version != version)
+
+            if feed.error is not None:
+                raise feed.error
+
+            version = feed.version
+            yield curr if feed.val is None else feed.val
+
+
+@core.operator
+async def new_owners(ic, article, name):
+    """ Count of the first values stored by the owners of the field. """
+    await ic.subscribe(article, name, misc.NEW_OWNER)
+    cv = misc.get_markdown_factory().get_cv(article.pk, name, misc.NEW_OWNER)
+
+    n = 0
+    while True:
+        yield n
+
+        async with cv:
+            await cv.wait()
+        n += 1
+
+
+class _Feed(object):
+    """ The latest stored value of the (article, name, owner) shared by the
+    readers, val is None if there is no value stored. """
+
+    def __init__(self):
+        self.val = None
+        self.version = 0
+        self.refs = 0
+        self.cv = asyncio.Condition()
+        self.task = None
+        self.error = None
+
+
+class _InputHub(object):
+    """ Multicast of the stored input values, one reader (database reads and
+    change notifications) per (article, name, owner) for all the consumers
+    of the process. The reader is stopped when the last subscriber leaves. """
+
+    def __init__(self):
+        self.feeds = dict()
+
+    def subscribe(self, article, name, owner):
+        return _Subscription(self, article, name, owner)
+
+    def stats(self):
+        return {
+            'feeds': len(self.feeds),
+            'subscribers': sum(f.refs for f in self.feeds.values()),
+        }
+
+    async def publish(self, feed, val):
+        async with feed.cv:
+            feed.val = val
+            feed.version += 1
+            feed.cv.notify_all()
+
+    async def run(self, feed, article, name, owner):
+        try:
+            await self.read(feed, article, name, owner)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            feed.error = e
+            await self.publish(feed, None)
+
+    async def read(self, feed, article, name, owner):
+        factory = misc.get_markdown_factory()
+        cv = factory.get_cv(article.pk, name, owner.pk)
+
+        # pk of the latest stored value seen, curr may be a newer value which
+        # is not stored yet (see consumers._InputWriter)
+        curr = None
+        base = None
+        woken = False
+        while True:
+            last = curr
+            curr = await self.update(article, name, owner, cv.latest if woken else None, curr, base, woken)
+
+            if curr is not None and curr['pk'] is not None:
+                base = curr['pk']
+
+            if not woken or curr is not last:
+                await self.publish(feed, curr)
+
+            async with cv:
+                await cv.wait()
+
+            factory.stats['wakeups'] += 1
+            woken = True
+
+    async def update(self, article, name, owner, c, curr, base, woken):
+        """ Return the value after the change c (None on the cold start or if
+        the change is not known), curr is returned if nothing changed. The
+        change carries the new value, the database is needed just on the
+        cold start or if some change was missed. """
+        factory = misc.get_markdown_factory()
+
+        if c is not None and c.get('pending'):
+            return {k: v for k, v in c.items() if k not in ['prev', 'pending']}
+
+        elif c is not None and c['pk'] == base:
+            factory.stats['spurious_wakeups'] += 1
+            return curr
+
+        elif c is not None and c['prev'] == base:
+            return {k: v for k, v in c.items() if k != 'prev'}
+
+        # a change without the value drops the pending value (see
+        # consumers._InputWriter.retry), the stored one is shown again
+        dropped = woken and c is None and curr is not None and curr['pk'] is None
+
+        factory.stats['input_reads'] += 1
+        try:
+            c = await db_get_input(article, name, owner, None if dropped else base)
+        except models.InputLatest.DoesNotExist:
+            return None if dropped else curr
+
+        if c is None:
+            if woken:
+                factory.stats['spurious_wakeups'] += 1
+            return curr
+
+        return c
+
+
+class _Subscription(object):
+    def __init__(self, hub, article, name, owner):
+        self.hub = hub
+        self.key = (article.pk, name, owner.pk)
+        self.args = (article, name, owner)
+
+    async def __aenter__(self):
+        feed = self.hub.feeds.get(self.key)
+        if feed is None:
+            feed = _Feed()
+            feed.task = asyncio.ensure_future(self.hub.run(feed, *self.args))
+            self.hub.feeds[self.key] = feed
+
+        feed.refs += 1
+        return feed
+
+    async def __aexit__(self, *exc):
+        feed = self.hub.feeds[self.key]
+        feed.refs -= 1
+
+        if feed.refs == 0:
+            del self.hub.feeds[self.key]
+            feed.task.cancel()
+
+
+def get_input_hub():
+    if get_input_hub._hub is None:
+        get_input_hub._hub = _InputHub()
+
+    return get_input_hub._hub
+
 
-        async with field['cv']:
-            await field['cv'].wait()
+get_input_hub._hub = None
 
 
 async def arg_stream(ic, user, arg):
@@ -2,31 +2,54 @@ import logging
 from django import template
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
+import functools
 import uuid
 import base64
 import ipdb  # NOQA
 
 import pygments
+
+from .. import blobs
 logger = logging.getLogger(__name__)
 
 register = template.Library()
 
+# the tab ids of the cached fragments, replaced by fill_uid after the lookup
+UID_PLACEHOLDER = 'dw-uid-placeholder'
+
+
+def fill_uid(html, uid=None):
+    return html.replace(UID_PLACEHOLDER, uid or f"dw-{uuid.uuid4()}")
+
+
 @register.simple_tag
-def get_uuid():
-    return str(uuid.uuid4())
+def get_uuid(uid=None):
+    return uid or str(uuid.uuid4())
+
+@functools.lru_cache(maxsize=256)
+def get_lexer_for_mimetype(mime_type):
+    try:
+        return pygments.lexers.get_lexer_for_mimetype(mime_type)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_formatter():
+    return pygments.formatters.HtmlFormatter(cssclass="codehilite")
+
 
 @register.filter
 @stringfilter
 def codehilite(value, arg):
-    try:
-        lexer = pygments.lexers.get_lexer_for_mimetype(arg)
-    except ValueError:
+    lexer = get_lexer_for_mimetype(arg)
+    if lexer is None:
         try:
             lexer = pygments.lexers.guess_lexer(value)
         except ValueError:
             lexer = pygments.lexers.TextLexer()
 
-    return mark_safe(pygments.highlight(value, lexer, pygments.formatters.HtmlFormatter(cssclass="codehilite")))
+    return mark_safe(pygments.highlight(value, lexer, get_formatter()))
 
 
 @register.filter
@@ -35,6 +58,22 @@ def b64decode(val):
     return base64.b64decode(val).decode('utf-8')
 
 
+@register.filter
+def file_b64(f):
+    """ base64 content of the file of the files input value """
+    return base64.b64encode(blobs.file_content(f)).decode('ascii')
+
+
+@register.filter
+def file_url(f, user_pk):
+    return blobs.file_url(f, user_pk)
+
+
+@register.filter
+def file_text(f):
+    return blobs.file_content(f).decode('utf-8')
+
+
 @register.filter
 def format_user(u):
     if u:
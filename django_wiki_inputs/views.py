@@ -0,0 +1,220 @@
+from django.contrib.auth.decorators import login_required
+from django.core import signing
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.html import escape
+from django.views.decorators.http import condition, require_safe
+from urllib.parse import quote
+import threading
+import logging
+import types
+import re
+
+from . import blobs
+from . import models
+from . import misc
+from . import settings
+from . import stream as my_stream
+from .mdx.input import InputPreprocessor, parse
+from .templatetags.wiki_forms_tags import UID_PLACEHOLDER, codehilite, fill_uid
+
+import ipdb # NOQA
+
+logger = logging.getLogger(__name__)
+
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# the types served inline, anything else is a download (the uploaded HTML or
+# SVG would run on the wiki origin)
+INLINE_TYPES = ['image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp']
+
+
+def get_file(request, token):
+    try:
+        f = blobs.file_token_loads(token)
+    except (signing.BadSignature, ValueError):
+        raise Http404
+
+    if f['user'] != request.user.pk:
+        raise Http404
+
+    if not blobs.get_blob_store().exists(f['digest']):
+        raise Http404
+
+    return f
+
+
+def file_etag(request, token):
+    return get_file(request, token)['digest'] + request.GET.get('format', '')
+
+
+def iter_file(fd, start, length):
+    with fd:
+        fd.seek(start)
+        while length > 0:
+            buf = fd.read(min(length, 64 * 1024))
+            if not buf:
+                break
+
+            length -= len(buf)
+            yield buf
+
+
+def file_html(f):
+    """ The tab content of the file in the display. """
+    url = blobs.file_url(f, f['user'])
+    mime = f.get('type') or 'text/plain'
+
+    if mime in INLINE_TYPES:
+        return f'<img src="{url}" alt="{escape(f.get("name") or "")}"/>'
+
+    try:
+        return codehilite(blobs.file_content(f).decode('utf-8'), mime)
+    except UnicodeDecodeError:
+        return f'<a href="{url}" download="{escape(f.get("name") or "")}">{escape(f.get("name") or url)}</a>'
+
+
+@require_safe
+@login_required
+@condition(etag_func=file_etag)
+def file_view(request, token):
+    """ Content of the file of the files input, the (signed) token is issued
+    by the display of the value. Supports the single range requests, the
+    content is immutable (addressed by the digest). """
+    f = get_file(request, token)
+
+    if request.GET.get('format') == 'html':
+        resp = HttpResponse(file_html(f))
+
+    else:
+        store = blobs.get_blob_store()
+        size = store.size(f['digest'])
+        start, end = 0, size - 1
+
+        m = range_re.match(request.META.get('HTTP_RANGE', ''))
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if m and (m.group(1) or m.group(2)) and (if_range is None or if_range.strip('"') == f['digest']):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(size - int(m.group(2)), 0)
+
+            if start > end or start >= size:
+                resp = HttpResponse(status=416)
+                resp['Content-Range'] = f'bytes */{size}'
+                return resp
+
+        inline = f.get('type') in INLINE_TYPES
+        resp = StreamingHttpResponse(iter_file(store.open(f['digest']), start, end - start + 1),
+                                     content_type=f['type'] if inline else 'application/octet-stream')
+        if (start, end) != (0, size - 1):
+            resp.status_code = 206
+            resp['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+        resp['Content-Length'] = str(end - start + 1)
+        resp['Accept-Ranges'] = 'bytes'
+        resp['Content-Disposition'] = f"{'inline' if inline else 'attachment'}; filename*=UTF-8''{quote(f.get('name') or f['digest'])}"
+        resp['X-Content-Type-Options'] = 'nosniff'
+        resp['Content-Security-Policy'] = 'sandbox'
+
+    patch_cache_control(resp, private=True, max_age=365 * 24 * 3600, immutable=True)
+    return resp
+
+
+def can_read_input(article, name, user):
+    """ The user can read the values of the input of the article, the
+    permissions of the field are applied as in the rendered article. """
+    if not article.can_read(user):
+        return False
+
+    for start, end, field in parse(article.current_revision.content):
+        if field['cmd'] == 'input' and field['name'] == name:
+            md = types.SimpleNamespace(article=article, user=user)
+            return InputPreprocessor(md).add_field(field)['can_read']
+
+    return False
+
+
+def history_url(pk):
+    """ Signed URL of the history of the value, the token is issued only to
+    the users who can see the value. """
+    token = signing.Signer(salt='django_wiki_inputs.history').sign(str(pk))
+    return reverse('wiki:inputs_history', kwargs={'token': token})
+
+
+def history_html(pk):
+    """ Placeholder of the history of the value, loaded on demand. """
+    return f'<div class="dw-history" data-src="{history_url(pk)}"></div>'
+
+
+def get_history_cache():
+    """ Rendered history items by the pk, the inputs are never changed. """
+    if get_history_cache._c is None:
+        get_history_cache._c = misc.LRUCache(settings.HISTORY_CACHE_SIZE)
+
+    return get_history_cache._c
+
+
+get_history_cache._c = None
+get_history_cache._lock = threading.Lock()
+
+
+def history_item(v, user):
+    val = my_stream.input_to_dict(v)
+
+    # the file URLs are valid just for the user
+    key = (v.pk, user.pk) if val['type'] in ['file', 'files'] else v.pk
+
+    with get_history_cache._lock:
+        try:
+            return fill_uid(get_history_cache().get(key))
+        except KeyError:
+            pass
+
+    html = render_to_string("wiki/plugins/inputs/pprint.html", context=dict(val, uid=UID_PLACEHOLDER, viewer=user.pk))
+    html = f"<li>{v.name} {v.created} {v.author} ({v.pk}): {html}</li>"
+
+    with get_history_cache._lock:
+        get_history_cache().put(key, html)
+
+    return fill_uid(html)
+
+
+@require_safe
+@login_required
+def history_view(request, token):
+    """ Page of the history of the value, the newest first, ?before=<pk>
+    continues after the given version. """
+    try:
+        pk = int(signing.Signer(salt='django_wiki_inputs.history').unsign(token))
+        i = models.Input.objects.select_related('article').get(pk=pk)
+    except (signing.BadSignature, ValueError, models.Input.DoesNotExist):
+        raise Http404
+
+    # the token is issued by a display of the value, the permissions could
+    # change since then
+    if not can_read_input(i.article, i.name, request.user):
+        raise Http404
+
+    qs = models.Input.objects.select_related('author').filter(article=i.article_id, name=i.name, owner=i.owner_id)
+
+    if 'before' in request.GET:
+        try:
+            before = qs.get(pk=int(request.GET['before']))
+        except (ValueError, models.Input.DoesNotExist):
+            raise Http404
+
+        qs = qs.filter(created__lt=before.created)
+
+    page = list(qs.order_by('-created')[:settings.HISTORY_PAGE_SIZE + 1])
+    out = "".join(history_item(v, request.user) for v in page[:settings.HISTORY_PAGE_SIZE])
+
+    html = f"<ul>{out}</ul>" if len(out) else ""
+    if len(page) > settings.HISTORY_PAGE_SIZE:
+        url = f"{history_url(pk)}?before={page[settings.HISTORY_PAGE_SIZE - 1].pk}"
+        html += f'<a href="#" class="dw-history-more" data-src="{url}">...</a>'
+
+    return HttpResponse(html)
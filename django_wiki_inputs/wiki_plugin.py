@@ -1,9 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
+from django.urls import re_path
 from django.utils.translation import ugettext as _
 from wiki.core.plugins import registry
 from wiki.core.plugins.base import BasePlugin
 from . import settings
+from . import views
 from .mdx.input import InputExtension
 from .mdx.source import SourceExtension
 
@@ -20,7 +22,10 @@ class InputsPlugin(BasePlugin):
 
     urlpatterns = {
         'article': list(),
-        'root': list()
+        'root': [
+            re_path(r'^file/(?P<token>[^/]+)/$', views.file_view, name='inputs_file'),
+            re_path(r'^history/(?P<token>[^/]+)/$', views.history_view, name='inputs_history'),
+        ]
     }
 
     sidebar = {'headline': _('Inputs'),
@@ -44,6 +44,9 @@ setup(
         ],
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     license="GNU General Public License v3",
     zip_safe=False,
     keywords='django_wiki_inputs',